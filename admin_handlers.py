@@ -3,7 +3,6 @@ import logging
 import os
 
 from django import forms
-from google.appengine.api import memcache
 from google.appengine.api import users
 from google.appengine.ext import deferred
 
@@ -12,10 +11,13 @@ import webapp2
 import xsrfutil
 
 import basehandler
+import cacheutil
 import config
 import markup
 import models
+import rerender
 import utils
+import warmer
 
 
 def with_post(fun):
@@ -46,16 +48,24 @@ def with_page(fun):
 
 class AdminHandler(basehandler.BaseHandler):
   def get(self):
-    offset = int(self.request.get('start', 0))
+    page = max(1, int(self.request.get('page', 1)))
     count = int(self.request.get('count', 20))
-    posts = models.BlogPost.all().order('-published').fetch(count, offset)
+    # Drafts have no published date and are listed last, so saving one does
+    # not move the cursors of the pages before.
+    def make_query(keys_only):
+      return models.BlogPost.all(keys_only=keys_only).order('-published')
+    posts = models.fetch_page(make_query, 'admin-posts',
+                              cacheutil.LISTING_DEP, page, count)
+    offset = (page - 1) * count
     self.templ.update({
+        'page': page,
         'offset': offset,
         'count': count,
         'last_post': offset + len(posts) - 1,
-        'prev_offset': max(0, offset - count),
-        'next_offset': offset + count,
         'posts': posts,
+        'cache_stats': cacheutil.get_stats(),
+        'warm_status': warmer.get_status(),
+        'rerender_status': rerender.get_status(),
     })
     self.render_to_response('admin/index.html')
 
@@ -146,14 +156,17 @@ class PageForm(djangoforms.ModelForm):
 
 class PageAdminHandler(basehandler.BaseHandler):
   def get(self):
-    offset = int(self.request.get('start', 0))
+    page = max(1, int(self.request.get('page', 1)))
     count = int(self.request.get('count', 20))
-    pages = models.Page.all().order('-updated').fetch(count, offset)
+    def make_query(keys_only):
+      return models.Page.all(keys_only=keys_only).order('-updated')
+    pages = models.fetch_page(make_query, 'admin-pages',
+                              cacheutil.PAGES_DEP, page, count)
+    offset = (page - 1) * count
     self.templ.update({
+        'page': page,
         'offset': offset,
         'count': count,
-        'prev_offset': max(0, offset - count),
-        'next_offset': offset + count,
         'last_page': offset + len(pages) - 1,
         'pages': pages,
     })
@@ -209,16 +222,32 @@ class PageDeleteHandler(basehandler.BaseHandler):
 class ClearCacheHandler(basehandler.BaseHandler):
   @xsrfutil.xsrf_protect
   def post(self):
-    memcache.flush_all()
+    cacheutil.flush()
     self.render_to_response('admin/cache_cleared.html')
 
 
+class RebuildLinksHandler(basehandler.BaseHandler):
+  @xsrfutil.xsrf_protect
+  def post(self):
+    deferred.defer(models.rebuild_post_links)
+    self.render_to_response('admin/links_rebuilding.html')
+
+
+class RerenderHandler(basehandler.BaseHandler):
+  @xsrfutil.xsrf_protect
+  def post(self):
+    rerender.start()
+    self.render_to_response('admin/rerendering.html')
+
+
 app = webapp2.WSGIApplication([
   ('/admin/', AdminHandler),
   ('/admin/posts', AdminHandler),
   ('/admin/pages', PageAdminHandler),
   ('/admin/newpost', PostHandler),
   ('/admin/clearcache', ClearCacheHandler),
+  ('/admin/rebuildlinks', RebuildLinksHandler),
+  ('/admin/rerender', RerenderHandler),
   ('/admin/post/delete(/.*)', DeleteHandler),
   ('/admin/post/preview(/.*)', PreviewHandler),
   ('/admin/post(/.*)', PostHandler),
@@ -1,4 +1,7 @@
+import email.utils
+import hashlib
 import os
+import threading
 
 from google.appengine.api import memcache
 from google.appengine.api import users
@@ -6,19 +9,101 @@ from google.appengine.api import users
 import jinja2
 import webapp2
 
+import cacheutil
 import config
+import markup
 import models
 import xsrfutil
 
 
-def cached(content_type='text/html; charset=utf-8'):
+# Jinja2 environments by theme, shared by all requests of this instance.
+_jinja_envs = {}
+_jinja_envs_lock = threading.Lock()
+
+
+def get_bytecode_cache():
+  """Returns the template bytecode cache selected in the config, if any."""
+  if config.template_bytecode_cache == 'memcache':
+    return jinja2.MemcachedBytecodeCache(memcache, prefix='jinja2:')
+  if config.template_bytecode_cache == 'filesystem':
+    directory = os.path.join(os.path.dirname(__file__),
+                             config.template_bytecode_dir)
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    return jinja2.FileSystemBytecodeCache(directory)
+  return None
+
+
+def get_jinja_env(theme=None):
+  """Returns the Jinja2 environment for the given theme.
+
+  The environment is built once per instance, so that compiled templates are
+  kept across requests. Templates not found in the theme fall back to the
+  default theme.
+  """
+  theme = theme or config.theme or 'default'
+  env = _jinja_envs.get(theme)
+  if env:
+    return env
+
+  with _jinja_envs_lock:
+    if theme not in _jinja_envs:
+      base_templ_dir = os.path.join(os.path.dirname(__file__), 'themes')
+      template_dirs = [os.path.abspath(os.path.join(base_templ_dir, 'default'))]
+      if theme != 'default':
+        template_dirs.insert(
+            0, os.path.abspath(os.path.join(base_templ_dir, theme)))
+
+      env = jinja2.Environment(
+          loader=jinja2.FileSystemLoader(template_dirs),
+          extensions=['jinja2.ext.autoescape'],
+          autoescape=True,
+          auto_reload=os.environ.get('SERVER_SOFTWARE', '').startswith('Devel'),
+          bytecode_cache=get_bytecode_cache())
+      # xsrf_token is computed for the current request's user and path.
+      env.globals['csrf_token'] = xsrfutil.xsrf_token
+      _jinja_envs[theme] = env
+    return _jinja_envs[theme]
+
+
+# Key in the WSGI environment of requests made by refresh_page().
+REFRESH_ENVIRON_KEY = 'bloggart.refresh'
+
+
+def refresh_page(path):
+  """Renders a cached page and stores it. Runs as deferred task."""
+  import main_handlers
+  main_handlers.app.get_response(path, environ={REFRESH_ENVIRON_KEY: True})
+
+
+def cached(content_type='text/html; charset=utf-8', max_stale=None):
   """Decorator for caching the output in memcache.
 
   Note that the decorator requires that the page is identified by a key passed
   as first argument to get/post functions bearing this decorator. This
   decorator should only be used if the output is always the same for the same
   key.
+
+  The decorated function declares what the output was built from by calling
+  add_deps() on the handler. The entry is considered stale as soon as one of
+  these dependencies is invalidated (see cacheutil).
+
+  Pages are sent with an ETag and a Last-Modified date, so that conditional
+  requests get a 304 response without rendering the page or fetching it from
+  memcache. Pages are stored gzip-compressed as well, and sent compressed to
+  clients accepting it.
+
+  Only one request at a time renders a page. Concurrent requests for it get
+  the stale page, or wait for the page to be rendered (see
+  cacheutil.render_once()).
+
+  Once a page is stale, i.e. one of its dependencies changed, the previous
+  version is served for up to max_stale seconds (config.max_stale by default)
+  while a deferred task renders it again.
   """
+  if max_stale is None:
+    max_stale = config.max_stale
+
   def wrapper(func):
     def decorate(self, *args, **kwargs):
       # Use the "key" argument, or the first non-kw argument, or the first kwarg.
@@ -26,16 +111,53 @@ def cached(content_type='text/html; charset=utf-8'):
       if not key and len(args) > 0:
         key = args[0]
 
-      handler_name = self.__class__.__name__
-      memcache_key = 'cache:%s:%s' % (handler_name, key)
-      cached_output = memcache.get(memcache_key)
-      if not cached_output or users.is_current_user_admin():
-        cached_output = func(self, *args, **kwargs)
-        if not users.is_current_user_admin():
-          memcache.set(memcache_key, cached_output)
+      # Task queue requests count as admin requests too, but have no user.
+      if self.templ['is_admin']:
+        # Admins always get a freshly rendered page, which is not stored.
+        self.response.headers['Content-Type'] = content_type
+        self.response.headers['Cache-Control'] = 'private, no-cache'
+        self.response.out.write(func(self, *args, **kwargs))
+        return
+
+      cache_key = 'cache:%s:%s' % (self.__class__.__name__, key)
+
+      # Conditional requests are likely answered with a 304, so the body is
+      # only fetched when it turns out to be needed.
+      encoding = self.accepts_gzip() and 'gzip' or 'identity'
+      conditional = self.is_conditional()
+      body_encoding = not conditional and encoding or None
 
-      self.response.headers['Content-Type'] = content_type
-      self.response.out.write(cached_output)
+      # Checking an entry in the in-process cache fetches the generation too.
+      entry, generation = cacheutil.get_local_entry(cache_key, body_encoding)
+      if generation is not None:
+        self.generation = generation
+      memcache_key = cacheutil.namespaced(cache_key, self.get_generation())
+      if not entry:
+        entry = cacheutil.get_entry(memcache_key, encoding=body_encoding)
+      if (entry and 'body' not in entry and
+          (entry['stale'] or not self.is_not_modified(entry, encoding))):
+        entry['body'] = cacheutil.get_body(memcache_key, entry, encoding)
+        if entry['body'] is None:
+          entry = None
+
+      refreshing = self.request.environ.get(REFRESH_ENVIRON_KEY)
+      if (entry and entry['stale'] and not refreshing and
+          cacheutil.serve_stale(memcache_key, entry, max_stale,
+                                refresh_page, self.request.path)):
+        entry['stale'] = False
+
+      if not entry or entry['stale']:
+        def render():
+          body = func(self, *args, **kwargs)
+          if isinstance(body, unicode):
+            body = body.encode('utf-8')
+          return body, self.response.status_int, self.deps
+        # Refreshes must not end up with the stale entry while another
+        # request renders the page, so they wait for it or render it.
+        entry = cacheutil.render_once(memcache_key, render, encoding,
+                                      not refreshing and entry or None)
+
+      self.write_cached(entry, content_type, encoding)
 
     return decorate
   return wrapper
@@ -46,29 +168,132 @@ class BaseHandler(webapp2.RequestHandler):
   def __init__(self, request=None, response=None):
     super(BaseHandler, self).__init__(request, response)
 
-    base_templ_dir = os.path.join(os.path.dirname(__file__), 'themes')
-    template_dirs = [os.path.abspath(os.path.join(base_templ_dir, 'default'))]
-    if config.theme and config.theme != 'default':
-      template_dirs.insert(0, os.path.abspath(os.path.join(base_templ_dir, config.theme)))
-
-    self.jinja = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(template_dirs),
-        extensions=['jinja2.ext.autoescape'],
-        autoescape=True)
-    self.jinja.globals['csrf_token'] = xsrfutil.xsrf_token
+    self.jinja = get_jinja_env()
 
     self.user = users.get_current_user()
 
+    # Dependencies of the output, see add_deps().
+    self.deps = {}
+
+    # Generation of the cache, see get_generation().
+    self.generation = None
+
     # Default template variables
     self.templ = {}
     self.templ['config'] = config
     self.templ['devel'] = os.environ['SERVER_SOFTWARE'].startswith('Devel')
-    self.templ['path'] = os.environ.get('PATH_INFO')
+    self.templ['path'] = self.request.path
     self.templ['handler_class'] = self.__class__.__name__
     self.templ['is_admin'] = False
     if self.user:
       self.templ['is_admin'] = users.is_current_user_admin()
 
+  def add_deps(self, *deps):
+    """Records dependencies the output of a cached() function is built from.
+
+    Call this before querying the data, so that an invalidation happening
+    while the page is rendered makes the new cache entry stale right away.
+    """
+    self.deps.update(cacheutil.get_versions(deps))
+
+  def get_generation(self):
+    """Returns the generation of the cache, fetched once per request."""
+    if self.generation is None:
+      self.generation = cacheutil.get_generation()
+    return self.generation
+
+  def is_known_path(self, path):
+    """Checks whether a post or page may exist at the path.
+
+    The cache generation is fetched along with the versions the set of known
+    paths depends on, so that cached() needs no RPC for it.
+    """
+    versions = cacheutil.get_versions([cacheutil.PATHS_DEP,
+                                       cacheutil.GENERATION_DEP])
+    self.generation = versions[cacheutil.GENERATION_DEP]
+    paths = models.get_known_paths(versions)
+    return paths is None or path in paths
+
+  def is_conditional(self):
+    """Checks whether the request is a conditional GET."""
+    headers = self.request.headers
+    return 'If-None-Match' in headers or 'If-Modified-Since' in headers
+
+  def accepts_gzip(self):
+    """Checks whether the client accepts gzip-compressed responses."""
+    for coding in self.request.headers.get('Accept-Encoding', '').split(','):
+      params = [param.strip() for param in coding.split(';')]
+      if params[0] in ('gzip', 'x-gzip'):
+        for param in params[1:]:
+          if param.startswith('q='):
+            try:
+              return float(param[2:]) > 0
+            except ValueError:
+              return False
+        return True
+    return False
+
+  def is_not_modified(self, entry, encoding):
+    """Checks whether the client's copy of a cached page is current."""
+    if entry['status'] != 200:
+      return False
+    if_none_match = self.request.headers.get('If-None-Match')
+    if if_none_match:
+      etags = [etag.strip() for etag in if_none_match.split(',')]
+      return cacheutil.get_etag(entry, encoding) in etags or '*' in etags
+    if_modified_since = self.request.headers.get('If-Modified-Since')
+    if if_modified_since:
+      since = email.utils.parsedate_tz(if_modified_since)
+      return (since is not None and
+              email.utils.mktime_tz(since) >= entry['last_modified'])
+    return False
+
+  def write_cached(self, entry, content_type, encoding):
+    """Writes a cache entry to the response, or a 304 if not modified."""
+    self.response.set_status(entry['status'])
+    self.response.headers['Vary'] = 'Accept-Encoding'
+    if entry['status'] == 200:
+      self.response.headers['ETag'] = cacheutil.get_etag(entry, encoding)
+      self.response.headers['Last-Modified'] = email.utils.formatdate(
+          entry['last_modified'], usegmt=True)
+      self.response.headers['Cache-Control'] = (
+          'public, max-age=%d' % config.http_max_age)
+      if self.is_not_modified(entry, encoding):
+        self.response.set_status(304)
+        return
+    self.response.headers['Content-Type'] = content_type
+    if encoding != 'identity':
+      self.response.headers['Content-Encoding'] = encoding
+    self.response.out.write(entry['body'])
+
+  def render_summaries(self, posts):
+    """Returns the summary.html fragments of the given posts.
+
+    Fragments are cached by post and by what the fragment is built from: the
+    source of the post, its tags and the render version of its markup. The
+    key is computed without rendering the post, so that an edit to a post
+    only renders its own fragment again, and listings showing other posts
+    reuse theirs. All fragments of a listing are fetched with one get_multi.
+    """
+    generation = self.get_generation()
+    keys = []
+    for post in posts:
+      source = (post.hash, post.tags, markup.get_render_version(post))
+      keys.append(cacheutil.namespaced(
+          'summary:%s:%s' % (post.key().name(),
+                             hashlib.sha1(repr(source)).hexdigest()),
+          generation))
+    fragments = memcache.get_multi(keys)
+    missing = {}
+    for key, post in zip(keys, posts):
+      if key not in fragments:
+        missing[key] = self.render('summary.html',
+                                   {'post': post, 'config': config})
+    if missing:
+      memcache.set_multi(missing)
+      fragments.update(missing)
+    return [fragments[key] for key in keys]
+
   def render_to_response(self, template_name, template_vals=None, theme=None,
                          content_type='text/html; charset=utf-8'):
     self.response.headers['Content-Type'] = content_type
@@ -77,12 +302,29 @@ class BaseHandler(webapp2.RequestHandler):
   def render(self, template_name, template_vals=None, theme=None):
     if not template_vals:
       template_vals = self.templ
-    template = self.jinja.get_template(template_name)
+    jinja = theme and get_jinja_env(theme) or self.jinja
+    template = jinja.get_template(template_name)
     return template.render(template_vals)
 
   def fail(self, error=404, template='404.html'):
     self.error(error)
+    if (error, template) == (404, '404.html') and not self.templ['is_admin']:
+      return self.render_not_found()
     return self.render(template)
 
+  def render_not_found(self):
+    """Returns the 404 page, which is the same for all paths.
+
+    It is rendered once and then kept in the in-process cache and memcache,
+    so that requests for unknown paths cost no rendering.
+    """
+    key = cacheutil.namespaced('not-found', self.get_generation())
+    body = cacheutil.local_cache.get(key) or memcache.get(key)
+    if body is None:
+      body = self.render('404.html', {'config': config})
+      memcache.set(key, body)
+    cacheutil.local_cache.put(key, body, len(body))
+    return body
+
   def fail_to_response(self, error=404, template='404.html'):
     self.response.out.write(self.fail(error, template))
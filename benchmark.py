@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""Benchmarks of the cold start and the rendering of the blog.
+
+The imports benchmark measures how long importing each module takes in a
+fresh process, i.e. the time a cold instance spends on it before it can
+serve its first request. Every module is imported several times, each time
+in a new process, and the median is reported.
+
+The render benchmark renders the body of every post of a local datastore
+file, as written by the development server, several times and reports the
+time per render for each markup language: with the converters reused across
+renders, and with a new converter for every render, as before they were
+reused. Highlighted code is not memoized between renders, so that both
+include highlighting. The first render of each language is reported
+separately, as it includes importing and setting up the engine.
+
+Usage:
+  benchmark.py --sdk ~/google_appengine imports
+  benchmark.py --sdk ~/google_appengine \\
+      --datastore_path ~/bloggart.datastore render
+"""
+
+import optparse
+import os
+import subprocess
+import sys
+import time
+
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Modules whose import time is measured: the request handlers, and the
+# modules only needed for rendering.
+IMPORT_MODULES = [
+    'main_handlers',
+    'admin_handlers',
+    'models',
+    'markup',
+    'highlighting',
+    'markdown',
+    'markdown_processor',
+    'textile',
+    'docutils.core',
+    'rst_directive',
+    'pygments.lexers',
+    'django.utils.html',
+    'django.utils.text',
+]
+
+
+def setup(options):
+  """Makes the modules of the app importable, as on App Engine."""
+  sys.path.insert(0, APP_DIR)
+  import static_export
+  static_export.setup_sdk(options.sdk)
+  os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+  os.environ.setdefault('CURRENT_VERSION_ID', 'benchmark.1')
+  os.environ.setdefault('SERVER_SOFTWARE', 'Bloggart benchmark')
+
+
+def time_import(options, module):
+  """Imports a module in this process and prints the time it took."""
+  setup(options)
+  start = time.time()
+  __import__(module)
+  print time.time() - start
+
+
+def benchmark_imports(options):
+  """Prints the median import time of every module in a fresh process."""
+  results = []
+  for module in IMPORT_MODULES:
+    durations = []
+    for _ in range(options.repeat):
+      output = subprocess.check_output([
+          sys.executable, os.path.abspath(__file__), '--sdk', options.sdk,
+          'import', module])
+      durations.append(float(output.strip().splitlines()[-1]))
+    durations.sort()
+    results.append((module, durations[len(durations) // 2]))
+
+  for module, duration in results:
+    print '%8.1f ms  %s' % (duration * 1000, module)
+
+
+def time_renders(posts, repeat, new_converters):
+  """Renders the body of every post repeat times.
+
+  Args:
+    posts: the posts to render.
+    repeat: number of renders of every post.
+    new_converters: whether to drop the converters of the markup engines
+      before every render.
+
+  Returns:
+    A dict mapping markup languages to [first render, number of further
+    renders, their total time] lists.
+  """
+  from google.appengine.api import memcache
+  import highlighting
+  import markup
+
+  results = {}
+  for _ in range(repeat):
+    for post in posts:
+      highlighting._cache.clear()
+      memcache.flush_all()
+      if new_converters:
+        markup._local.__dict__.clear()
+      start = time.time()
+      markup.render_body(post)
+      duration = time.time() - start
+      if post.body_markup not in results:
+        results[post.body_markup] = [duration, 0, 0.0]
+      else:
+        results[post.body_markup][1] += 1
+        results[post.body_markup][2] += duration
+  return results
+
+
+def benchmark_render(options):
+  """Prints the time per render of the posts of each markup language."""
+  import static_export
+  setup(options)
+  static_export.setup_stubs(options)
+  import models
+
+  q = models.BlogPost.all()
+  q.filter('is_deleted =', False)
+  # Drafts that were never published have no body.
+  posts = [post for post in q.run(batch_size=100) if post.body is not None]
+
+  reused = time_renders(posts, options.repeat, False)
+  new = time_renders(posts, options.repeat, True)
+  for name, (first, count, total) in sorted(reused.iteritems()):
+    _, new_count, new_total = new[name]
+    print '%-10s first %8.1f ms, then %8.2f ms per render (%d renders)' % (
+        name, first * 1000, count and total * 1000 / count, count)
+    print '%-10s with new converters %8.2f ms per render' % (
+        '', new_count and new_total * 1000 / new_count)
+
+
+def parse_args(argv):
+  parser = optparse.OptionParser(usage='%prog [options] imports|render')
+  parser.add_option('--sdk', default=os.environ.get('APPENGINE_SDK', ''),
+                    help='path of the App Engine SDK')
+  parser.add_option('--repeat', type='int', default=5,
+                    help='number of measurements per module or post')
+  parser.add_option('--datastore_path',
+                    help='datastore file written by the development server')
+  parser.add_option('--use_sqlite', action='store_true', default=False,
+                    help='the datastore file is a SQLite database')
+  parser.add_option('--app_id', help='application ID of the datastore file')
+  options, args = parser.parse_args(argv)
+  if not args or args[0] not in ('imports', 'import', 'render'):
+    parser.error('unknown benchmark')
+  if args[0] == 'render' and not options.datastore_path:
+    parser.error('the render benchmark requires --datastore_path')
+  return options, args
+
+
+def main(argv):
+  options, args = parse_args(argv)
+  if args[0] == 'import':
+    # Runs in the child processes of the imports benchmark.
+    time_import(options, args[1])
+  elif args[0] == 'render':
+    benchmark_render(options)
+  else:
+    benchmark_imports(options)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,481 @@
+"""Dependency tracking for pages cached by basehandler.cached().
+
+Every cached page records the dependencies it was built from, e.g. the post
+it shows, the tag or archive month it lists, or the front page listing. Each
+dependency has a version number in memcache. Invalidating a dependency bumps
+its version, which makes every cache entry recorded against an older version
+stale, while entries built from other dependencies stay untouched.
+"""
+
+import collections
+import gzip
+import hashlib
+import os
+import threading
+import time
+from cStringIO import StringIO
+
+from google.appengine.api import memcache
+from google.appengine.ext import deferred
+
+import config
+
+
+# Dependency whose version is the generation number of the whole cache, see
+# flush(). Being a dependency, it can be fetched along with other ones.
+GENERATION_DEP = 'generation'
+
+# Prefix of the memcache keys holding the dependency versions.
+DEP_PREFIX = 'dep:'
+
+# Suffix of the memcache keys of the leases for rendering pages.
+LEASE_SUFFIX = ':lease'
+
+# Seconds after which the lease of a request that failed to render expires.
+LEASE_TIMEOUT = 30
+
+# Seconds a request waits for another one to render a page, and the interval
+# of checking whether it is done.
+LEASE_WAIT = 3
+LEASE_POLL_INTERVAL = 0.1
+
+# Suffix of the memcache keys marking that a stale page is being refreshed in
+# the background. The value is the time the page was first served stale.
+REFRESH_SUFFIX = ':refresh'
+
+# Prefix of the memcache keys of the counters, see get_stats().
+STATS_PREFIX = 'stats:'
+
+# Counters of rendered pages, of the renders saved by render_once() and of
+# stale pages served while being refreshed in the background.
+STATS = ('renders', 'collapsed_stale', 'collapsed_wait', 'lease_timeouts',
+         'served_stale')
+
+# Seconds entries of pages with an error status, e.g. 404, are kept.
+NEGATIVE_TTL = 60
+
+# Bodies of cache entries are split into chunks of this size, so that they
+# fit into memcache values. These are limited to 10^6 bytes, which includes
+# the key, the ETag stored with each chunk and the pickle overhead.
+MAX_CHUNK_SIZE = 900 * 1000
+
+# Dependencies that are not tied to a single post, tag or month.
+LISTING_DEP = 'listing'
+FEED_DEP = 'feed'
+SITEMAP_DEP = 'sitemap'
+ARCHIVE_INDEX_DEP = 'archive'
+PAGES_DEP = 'pages'
+
+# Dependency of the set of known paths, see models.get_known_paths().
+PATHS_DEP = 'paths'
+
+
+def get_generation():
+  """Returns the current generation number of the cache.
+
+  This costs a memcache RPC, so requests fetch it once, preferably along with
+  other dependencies (see GENERATION_DEP).
+  """
+  return get_versions([GENERATION_DEP])[GENERATION_DEP]
+
+
+def namespaced(key, generation=None):
+  """Returns the key in the namespace of this deployment and generation."""
+  if generation is None:
+    generation = get_generation()
+  return '%s:%s:%s' % (os.environ.get('CURRENT_VERSION_ID', ''),
+                       generation, key)
+
+
+def flush():
+  """Makes all namespaced cache entries unreachable.
+
+  Unlike memcache.flush_all(), this leaves other users of memcache (e.g. the
+  XSRF secret) alone. The old entries are evicted by memcache over time.
+  """
+  bump(GENERATION_DEP)
+
+
+def post_dep(path):
+  return 'post:%s' % path
+
+
+def tag_dep(tag):
+  return 'tag:%s' % tag
+
+
+def month_dep(year, month):
+  return 'month:%d/%02d' % (year, month)
+
+
+def page_dep(path):
+  return 'page:%s' % path
+
+
+def get_versions(deps):
+  """Returns a dict mapping the given dependencies to their current version.
+
+  Dependencies without a version in memcache (never seen before, or evicted)
+  get a fresh one. It is derived from the current time, so that it never
+  matches a version recorded before the eviction.
+  """
+  deps = list(deps)
+  if not deps:
+    return {}
+  versions = memcache.get_multi(deps, key_prefix=DEP_PREFIX)
+  missing = [dep for dep in deps if dep not in versions]
+  if missing:
+    initial = int(time.time() * 1000)
+    memcache.add_multi(dict((dep, initial) for dep in missing),
+                       key_prefix=DEP_PREFIX)
+    versions.update(memcache.get_multi(missing, key_prefix=DEP_PREFIX))
+  return versions
+
+
+def is_current(recorded, versions=None):
+  """Checks whether the recorded dependency versions are still current.
+
+  Args:
+    recorded: dict mapping dependencies to the version they had when the
+      cache entry was built.
+    versions: the current versions of the dependencies, fetched from memcache
+      if not given.
+  """
+  if not recorded:
+    return True
+  if versions is None:
+    versions = memcache.get_multi(recorded.keys(), key_prefix=DEP_PREFIX)
+  for dep, version in recorded.iteritems():
+    if versions.get(dep) != version:
+      return False
+  return True
+
+
+class LRUCache(object):
+  """Thread-safe LRU cache limiting the total size of its values."""
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.size = 0
+    self._items = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    with self._lock:
+      item = self._items.pop(key, None)
+      if item is None:
+        return None
+      self._items[key] = item
+      return item[0]
+
+  def put(self, key, value, size):
+    """Stores a value of the given size, evicting the oldest ones if needed.
+
+    Values larger than an eighth of the cache are not stored, so that a few
+    big pages don't push out all others.
+    """
+    with self._lock:
+      self._remove(key)
+      if size > self.max_size / 8:
+        return
+      self._items[key] = (value, size)
+      self.size += size
+      while self.size > self.max_size:
+        _, (_, old_size) = self._items.popitem(last=False)
+        self.size -= old_size
+
+  def delete(self, key):
+    with self._lock:
+      self._remove(key)
+
+  def clear(self):
+    with self._lock:
+      self._items.clear()
+      self.size = 0
+
+  def _remove(self, key):
+    item = self._items.pop(key, None)
+    if item:
+      self.size -= item[1]
+
+
+# In-process tier in front of memcache for cache entries of this instance,
+# mapping keys to (entry, dict of bodies by encoding) tuples.
+local_cache = LRUCache(config.local_cache_size)
+
+
+def _local_key(key):
+  """Returns the in-process cache key for the key of a cache entry.
+
+  It leaves out the generation, so that entries can be looked up before the
+  generation is known. Entries there record it as dependency instead.
+  """
+  version, generation, rest = key.split(':', 2)
+  return '%s:%s' % (version, rest)
+
+
+def _remember(key, entry, bodies):
+  """Puts a current entry and its bodies into the in-process cache."""
+  entry = dict((name, value) for name, value in entry.iteritems()
+               if name != 'body')
+  entry['deps'] = dict(entry['deps'])
+  entry['deps'][GENERATION_DEP] = int(key.split(':', 2)[1])
+  local_key = _local_key(key)
+  local = local_cache.get(local_key)
+  if local and local[0]['etag'] == entry['etag']:
+    bodies = dict(local[1], **bodies)
+  local_cache.put(local_key, (entry, bodies),
+                  sum(map(len, bodies.itervalues())))
+
+
+def get_local_entry(key, encoding=None):
+  """Returns a copy of the entry in the in-process cache, if it's current.
+
+  The in-process cache of another instance may have seen newer versions of
+  the entry's dependencies or a newer generation, so these are checked with
+  one get_multi().
+
+  Args:
+    key: key of the entry without namespace, see namespaced().
+    encoding: encoding of the body to return with the entry, if any.
+
+  Returns:
+    An (entry, generation) tuple. The entry is None if there is no current
+    one with a body in the encoding. The generation is the current one if it
+    was fetched to check the entry, else None.
+  """
+  local_key = '%s:%s' % (os.environ.get('CURRENT_VERSION_ID', ''), key)
+  local = local_cache.get(local_key)
+  if not local:
+    return None, None
+  entry, bodies = local
+  if encoding and encoding not in bodies:
+    return None, None
+  versions = memcache.get_multi(entry['deps'].keys(), key_prefix=DEP_PREFIX)
+  generation = versions.get(GENERATION_DEP)
+  if not is_current(entry['deps'], versions):
+    local_cache.delete(local_key)
+    return None, generation
+  entry = dict(entry)
+  if encoding:
+    entry['body'] = bodies[encoding]
+  return entry, generation
+
+
+def get_entry(key, encoding=None):
+  """Returns the cache entry stored under key.
+
+  An entry is a dict with the 'status', 'etag', 'last_modified' (seconds since
+  the epoch), 'deps' and 'chunks' of a page. The body is stored under its own
+  keys, once as is and once gzip-compressed, so that conditional requests can
+  be answered without fetching it. If an encoding is given, the body in that
+  encoding is fetched along with the entry and returned as 'body'.
+
+  Entries built from outdated dependencies are returned too, with 'stale' set,
+  so that they can be served while the page is rendered again. 'stale_since'
+  is the time a stale entry was first served, if it was.
+
+  Current entries are kept in an in-process cache as well, which is looked up
+  with get_local_entry() before this.
+
+  Returns:
+    The entry, or None if it is missing, or if the body is requested but
+    missing.
+  """
+  keys = [key, key + REFRESH_SUFFIX]
+  if encoding:
+    keys.append(_chunk_key(key, encoding, 0))
+  values = memcache.get_multi(keys)
+  entry = values.get(key)
+  if not entry:
+    return None
+  entry['stale'] = not is_current(entry['deps'])
+  entry['stale_since'] = values.get(key + REFRESH_SUFFIX)
+  if encoding:
+    entry['body'] = get_body(key, entry, encoding, values)
+    if entry['body'] is None:
+      return None
+    if not entry['stale'] and entry['status'] == 200:
+      _remember(key, entry, {encoding: entry['body']})
+  return entry
+
+
+def get_body(key, entry, encoding, values=None):
+  """Returns the body of a cache entry, or None if it is missing.
+
+  Args:
+    key: memcache key of the entry.
+    entry: the entry.
+    encoding: 'identity' or 'gzip'.
+    values: chunks of the body that have already been fetched, by key.
+  """
+  local = local_cache.get(_local_key(key))
+  if local and local[0]['etag'] == entry['etag'] and encoding in local[1]:
+    return local[1][encoding]
+
+  keys = [_chunk_key(key, encoding, i)
+          for i in range(entry['chunks'][encoding])]
+  values = dict(values or {})
+  missing = [chunk_key for chunk_key in keys if chunk_key not in values]
+  if missing:
+    values.update(memcache.get_multi(missing))
+
+  chunks = []
+  for chunk_key in keys:
+    # Chunks are stored with the ETag of their entry, so that chunks of
+    # another version of the entry are never returned.
+    value = values.get(chunk_key)
+    if not value or value[0] != entry['etag']:
+      return None
+    chunks.append(value[1])
+  return ''.join(chunks)
+
+
+def _chunk_key(key, encoding, index):
+  return '%s:%s:%d' % (key, encoding, index)
+
+
+def split(data):
+  """Splits data into chunks fitting into memcache values."""
+  return [data[i:i + MAX_CHUNK_SIZE]
+          for i in range(0, len(data), MAX_CHUNK_SIZE)] or ['']
+
+
+def gzip_compress(data):
+  out = StringIO()
+  f = gzip.GzipFile(fileobj=out, mode='wb', compresslevel=6, mtime=0)
+  f.write(data)
+  f.close()
+  return out.getvalue()
+
+
+def get_etag(entry, encoding):
+  """Returns the ETag of an entry's body in the given encoding."""
+  if encoding == 'identity':
+    return entry['etag']
+  return '%s-%s"' % (entry['etag'][:-1], encoding)
+
+
+def set_entry(key, body, status, deps, encoding='identity'):
+  """Stores a page as cache entry and returns the entry.
+
+  Args:
+    key: memcache key of the entry.
+    body: the page, as byte string.
+    status: HTTP status of the page.
+    deps: dict mapping the dependencies of the page to their versions.
+    encoding: encoding of the body returned with the entry.
+  """
+  entry = {
+      'stale': False,
+      'stale_since': None,
+      'status': status,
+      'etag': '"%s"' % hashlib.sha1(body).hexdigest(),
+      'last_modified': int(time.time()),
+      'deps': deps,
+      'chunks': {},
+  }
+  bodies = {'identity': body, 'gzip': gzip_compress(body)}
+  values = {key: entry}
+  for body_encoding, data in bodies.iteritems():
+    chunks = split(data)
+    entry['chunks'][body_encoding] = len(chunks)
+    for i, chunk in enumerate(chunks):
+      values[_chunk_key(key, body_encoding, i)] = (entry['etag'], chunk)
+  if status == 200:
+    memcache.set_multi(values)
+    _remember(key, entry, bodies)
+  else:
+    memcache.set_multi(values, time=NEGATIVE_TTL)
+  memcache.delete(key + REFRESH_SUFFIX)
+
+  entry['body'] = bodies[encoding]
+  return entry
+
+
+def render_once(key, render, encoding, stale=None):
+  """Renders a page and stores it, unless another request is already at it.
+
+  Rendering a page takes a lease on its key. Requests finding the lease taken
+  serve the stale entry if there is one, or wait up to LEASE_WAIT seconds for
+  the new entry. This way, a popular page that has just been invalidated is
+  rendered once instead of by every request at the same time.
+
+  Args:
+    key: memcache key of the entry.
+    render: function returning the page's body, HTTP status and dependencies.
+    encoding: encoding of the body returned with the entry.
+    stale: stale entry of the page with body, if any.
+
+  Returns:
+    The cache entry of the page.
+  """
+  lease_key = key + LEASE_SUFFIX
+  leased = memcache.add(lease_key, 1, time=LEASE_TIMEOUT)
+  if not leased:
+    if stale:
+      incr_stat('collapsed_stale')
+      return stale
+    deadline = time.time() + LEASE_WAIT
+    while time.time() < deadline:
+      time.sleep(LEASE_POLL_INTERVAL)
+      entry = get_entry(key, encoding)
+      if entry and not entry['stale']:
+        incr_stat('collapsed_wait')
+        return entry
+    incr_stat('lease_timeouts')
+
+  try:
+    body, status, deps = render()
+    incr_stat('renders')
+    return set_entry(key, body, status, deps, encoding)
+  finally:
+    if leased:
+      memcache.delete(lease_key)
+
+
+def serve_stale(key, entry, max_stale, refresh, *args):
+  """Checks whether a stale entry can be served, and refreshes it if so.
+
+  Stale entries can be served for max_stale seconds after they were first
+  served. The first request serving it schedules the refresh function with
+  the given arguments as deferred task, which is expected to render the page
+  again. If the task fails, the entry is rendered by a request once
+  max_stale seconds have passed.
+
+  Returns:
+    True if the entry can be served.
+  """
+  if not max_stale or entry['status'] != 200:
+    return False
+  now = int(time.time())
+  if entry['stale_since'] is None:
+    if memcache.add(key + REFRESH_SUFFIX, now):
+      deferred.defer(refresh, *args)
+  elif now - entry['stale_since'] > max_stale:
+    return False
+  incr_stat('served_stale')
+  return True
+
+
+def incr_stat(name):
+  memcache.incr(STATS_PREFIX + name, initial_value=0)
+
+
+def get_stats():
+  """Returns a dict with the values of the counters in STATS."""
+  values = memcache.get_multi(STATS, key_prefix=STATS_PREFIX)
+  return dict((name, values.get(name, 0)) for name in STATS)
+
+
+def bump(dep):
+  """Invalidates a single dependency and returns its new version."""
+  return memcache.incr(DEP_PREFIX + dep, initial_value=int(time.time() * 1000))
+
+
+def invalidate(deps):
+  """Invalidates all cache entries built from any of the given dependencies."""
+  deps = set(deps)
+  if deps:
+    memcache.offset_multi(dict((dep, 1) for dep in deps),
+                          key_prefix=DEP_PREFIX)
@@ -14,6 +14,23 @@ host = 'blog.websec.at'
 # the 'themes' directory, containing templates and static content.
 theme = 'default'
 
+# Cache for compiled templates, so that new instances don't have to compile
+# them again. One of 'memcache', 'filesystem' or None. The 'filesystem' cache
+# needs a writable directory (e.g. the development server or static exports).
+template_bytecode_cache = 'memcache'
+
+# Directory for the 'filesystem' template cache, relative to the app.
+template_bytecode_dir = '.jinja_cache'
+
+# (Optional) directory of a static export of the blog (see static_export.py),
+# relative to the app. If set, the exported files affected by a change to a
+# post or page are regenerated right away. Needs a writable file system, e.g.
+# the development server.
+static_export_dir = None
+
+# Number of listing pages regenerated in the static export when a post changes.
+static_regenerate_pages = 3
+
 # List of page templates
 page_templates = {
   'Theme.html': 'Theme',
@@ -43,6 +60,31 @@ sidebars = [
 # Number of entries per page in indexes.
 posts_per_page = 10
 
+# Seconds browsers and proxies may cache pages without checking for changes.
+http_max_age = 300
+
+# Seconds a cached page may still be served after it changed, while it is
+# rendered again in the background.
+max_stale = 60
+
+# Bytes of memory each instance may use to keep cached pages, in addition to
+# memcache.
+local_cache_size = 16 * 1024 * 1024
+
+# Bytes of memory each instance may use to keep highlighted code blocks.
+highlight_cache_size = 4 * 1024 * 1024
+
+# Lexers whose regexes are compiled when an instance warms up.
+highlight_precompile_lexers = ['python', 'c', 'bash', 'js']
+
+# Pages rendered into the cache after a deploy or publish: the number of
+# listing pages, of newest posts and of tags with the most posts.
+warm_listing_pages = 3
+warm_posts = 10
+warm_tags = 5
+# Tags are ranked by their posts among this many newest posts.
+warm_tag_posts = 100
+
 # The mime type to serve HTML files as.
 html_mime_type = "text/html; charset=utf-8"
 
@@ -68,6 +110,14 @@ default_markup = 'html'
 # 'friendly', 'native'.
 highlighting_style = 'friendly'
 
+# Number of worker processes rendering reStructuredText and Markdown, or 0 to
+# render in the request. App Engine doesn't allow starting processes, so this
+# is for the development server and the command line tools only.
+render_processes = 0
+
+# Seconds to wait for a worker process before rendering in the request.
+render_timeout = 10
+
 # Defines where the user is defined in the rel="me" of your pages.
 # This allows you to expand on your social graph.
 rel_me = None
@@ -0,0 +1,126 @@
+"""Memoized syntax highlighting with Pygments.
+
+Highlighted code depends only on the lexer alias, the formatter options and
+the code itself, so the HTML is cached under a digest of the three (and the
+Pygments version). Re-rendering a post whose code blocks didn't change then
+costs no lexing at all. Results are kept in an in-process LRU cache in front
+of memcache.
+
+Lexers are looked up in an alias index built once per process, and their
+instances are reused across code blocks. Creating the first instance of a
+lexer class compiles its token regexes, which precompile() does for the
+commonly used languages when an instance warms up.
+"""
+
+import hashlib
+import logging
+import threading
+import time
+
+from google.appengine.api import memcache
+
+import pygments
+from pygments import lexers
+from pygments.lexers import _mapping
+
+import cacheutil
+import config
+
+
+# Prefix of the memcache keys of highlighted code.
+HIGHLIGHT_PREFIX = 'highlight:'
+
+# Highlighted code blocks of this instance, by memcache key.
+_cache = cacheutil.LRUCache(config.highlight_cache_size)
+
+# Maps lexer aliases to (module name, class name) tuples, see get_lexer().
+_lexer_index = None
+
+# Lexer instances by alias.
+_lexers = {}
+_lexers_lock = threading.Lock()
+
+
+def _build_lexer_index():
+  index = {}
+  for module_name, name, aliases, _, _ in _mapping.LEXERS.itervalues():
+    for alias in aliases:
+      index.setdefault(alias, (module_name, name))
+  return index
+
+
+def get_lexer(alias):
+  """Returns the shared lexer instance for an alias.
+
+  Aliases are case-sensitive, as in pygments.lexers.get_lexer_by_name().
+  Unknown aliases get the plain text lexer.
+  """
+  global _lexer_index
+  lexer = _lexers.get(alias)
+  if lexer is not None:
+    return lexer
+  with _lexers_lock:
+    if _lexer_index is None:
+      _lexer_index = _build_lexer_index()
+    entry = _lexer_index.get(alias)
+    if entry:
+      module_name, name = entry
+      if name not in lexers._lexer_cache:
+        lexers._load_lexers(module_name)
+      lexer = lexers._lexer_cache[name]()
+    else:
+      # Lexers of setuptools plugins aren't in the index.
+      try:
+        lexer = lexers.get_lexer_by_name(alias)
+      except ValueError:
+        lexer = lexers.TextLexer()
+    _lexers[alias] = lexer
+  return lexer
+
+
+def precompile(aliases):
+  """Loads the lexers for the given aliases and compiles their regexes."""
+  start = time.time()
+  for alias in aliases:
+    get_lexer(alias)
+  logging.info('Precompiled %d lexers in %.1f ms.', len(aliases),
+               (time.time() - start) * 1000)
+
+
+def get_formatter_key(formatter):
+  """Returns a string identifying the options of a formatter."""
+  key = getattr(formatter, '_highlight_key', None)
+  if key is None:
+    key = repr(sorted(formatter.options.items()))
+    formatter._highlight_key = key
+  return key
+
+
+def get_cache_key(code, alias, formatter):
+  """Returns the cache key of a code block."""
+  digest = hashlib.sha1(repr((pygments.__version__, alias,
+                              get_formatter_key(formatter), code)))
+  return HIGHLIGHT_PREFIX + digest.hexdigest()
+
+
+def highlight(code, alias, formatter):
+  """Highlights code, like pygments.highlight(), but cached.
+
+  Args:
+    code: the source code to highlight.
+    alias: the name of the lexer, see pygments.lexers.get_lexer_by_name().
+      Unknown lexers fall back to plain text.
+    formatter: the Pygments formatter.
+  Returns:
+    The highlighted code.
+  """
+  key = get_cache_key(code, alias, formatter)
+  html = _cache.get(key)
+  if html is not None:
+    return html
+  html = memcache.get(key)
+  if html is None:
+    html = pygments.highlight(code, get_lexer(alias), formatter)
+    memcache.set(key, html)
+  _cache.put(key, html, len(html))
+  return html
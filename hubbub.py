@@ -0,0 +1,64 @@
+"""PubSubHubbub notifications for the Atom feed.
+
+Pings are never sent from a request for the feed. Every change to the feed
+schedules a deferred ping instead, and all changes within PING_WINDOW seconds
+share one ping. Failed pings are retried with the backoff configured for the
+PING_QUEUE queue in queue.yaml.
+"""
+
+import logging
+import os
+import time
+import urllib
+
+from google.appengine.api import taskqueue
+from google.appengine.api import urlfetch
+from google.appengine.ext import deferred
+
+import config
+
+
+# Changes within this many seconds are announced with a single ping.
+PING_WINDOW = 30
+
+# Task queue of the pings.
+PING_QUEUE = 'hubbub'
+
+
+class PingError(Exception):
+  """The hub didn't accept a ping."""
+
+
+def schedule_ping():
+  """Schedules a ping of the hub at the end of the current window."""
+  if (not config.hubbub_hub_url or
+      os.environ.get('SERVER_SOFTWARE', '').startswith('Devel')):
+    return
+
+  now = time.time()
+  window = int(now) // PING_WINDOW
+  try:
+    deferred.defer(ping, config.hubbub_hub_url,
+                   _name='hubbub-ping-%d' % window,
+                   _countdown=(window + 1) * PING_WINDOW - now,
+                   _queue=PING_QUEUE)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    # Another change in this window already scheduled the ping.
+    pass
+
+
+def ping(hub_url):
+  """Notifies the hub that the Atom feed has been updated.
+
+  Raises PingError if the hub doesn't accept the ping, so that the task is
+  retried.
+  """
+  data = urllib.urlencode({
+      'hub.url': 'http://%s/feeds/atom.xml' % (config.host,),
+      'hub.mode': 'publish',
+  })
+  response = urlfetch.fetch(url=hub_url, payload=data, method=urlfetch.POST)
+  if response.status_code not in (200, 204):
+    raise PingError('Hub %s returned HTTP status %d: %s' % (
+        hub_url, response.status_code, response.content))
+  logging.info('Pinged hub %s.', hub_url)
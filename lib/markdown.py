@@ -31,7 +31,7 @@ License: GPL 2 (http://www.gnu.org/copyleft/gpl.html) or BSD
 """
 
 
-import re, sys, codecs
+import re, sys, codecs, copy
 
 from logging import getLogger, StreamHandler, Formatter, \
                     DEBUG, INFO, WARN, ERROR, CRITICAL
@@ -1170,13 +1170,25 @@ class Markdown:
         self.stripTopLevelTags = 1
         self.docType = ""
 
-        self.textPreprocessors = [HTML_BLOCK_PREPROCESSOR]
+        # Own copies of the processors and patterns that keep the state of
+        # the current document, so that instances can be used by several
+        # threads at the same time. The copies share the compiled regexps.
+        self.htmlBlockPreprocessor = copy.copy(HTML_BLOCK_PREPROCESSOR)
+        self.linePreprocessor = copy.copy(LINE_PREPROCESSOR)
+        self.referencePreprocessor = copy.copy(REFERENCE_PREPROCESSOR)
+        self.htmlPattern = copy.copy(HTML_PATTERN)
+        self.entityPattern = copy.copy(ENTITY_PATTERN)
+        self.referencePattern = copy.copy(REFERENCE_PATTERN)
+        self.imageReferencePattern = copy.copy(IMAGE_REFERENCE_PATTERN)
+        self.rawHtmlTextPostprocessor = copy.copy(RAWHTMLTEXTPOSTPROCESSOR)
+
+        self.textPreprocessors = [self.htmlBlockPreprocessor]
 
         self.preprocessors = [HEADER_PREPROCESSOR,
-                              LINE_PREPROCESSOR,
+                              self.linePreprocessor,
                               # A footnote preprocessor will
                               # get inserted here
-                              REFERENCE_PREPROCESSOR]
+                              self.referencePreprocessor]
 
 
         self.postprocessors = [] # a footnote postprocessor will get
@@ -1184,7 +1196,7 @@ class Markdown:
 
         self.textPostprocessors = [# a footnote postprocessor will get
                                    # inserted here
-                                   RAWHTMLTEXTPOSTPROCESSOR]
+                                   self.rawHtmlTextPostprocessor]
 
         self.prePatterns = []
         
@@ -1192,17 +1204,17 @@ class Markdown:
         self.inlinePatterns = [DOUBLE_BACKTICK_PATTERN,
                                BACKTICK_PATTERN,
                                ESCAPE_PATTERN,
-                               REFERENCE_PATTERN,
+                               self.referencePattern,
                                LINK_ANGLED_PATTERN,
                                LINK_PATTERN,
                                IMAGE_LINK_PATTERN,
-			                   IMAGE_REFERENCE_PATTERN,
+			                   self.imageReferencePattern,
 			                   AUTOLINK_PATTERN,
                                AUTOMAIL_PATTERN,
                                LINE_BREAK_PATTERN_2,
                                LINE_BREAK_PATTERN,
-                               HTML_PATTERN,
-                               ENTITY_PATTERN,
+                               self.htmlPattern,
+                               self.entityPattern,
                                NOT_STRONG_PATTERN,
                                STRONG_EM_PATTERN,
                                STRONG_EM_PATTERN_2,
@@ -1257,15 +1269,15 @@ class Markdown:
         self.references={}
         self.htmlStash = HtmlStash()
 
-        HTML_BLOCK_PREPROCESSOR.stash = self.htmlStash
-        LINE_PREPROCESSOR.stash = self.htmlStash
-        REFERENCE_PREPROCESSOR.references = self.references
-        HTML_PATTERN.stash = self.htmlStash
-        ENTITY_PATTERN.stash = self.htmlStash
-        REFERENCE_PATTERN.references = self.references
-        IMAGE_REFERENCE_PATTERN.references = self.references
-        RAWHTMLTEXTPOSTPROCESSOR.stash = self.htmlStash
-        RAWHTMLTEXTPOSTPROCESSOR.safeMode = self.safeMode
+        self.htmlBlockPreprocessor.stash = self.htmlStash
+        self.linePreprocessor.stash = self.htmlStash
+        self.referencePreprocessor.references = self.references
+        self.htmlPattern.stash = self.htmlStash
+        self.entityPattern.stash = self.htmlStash
+        self.referencePattern.references = self.references
+        self.imageReferencePattern.references = self.references
+        self.rawHtmlTextPostprocessor.stash = self.htmlStash
+        self.rawHtmlTextPostprocessor.safeMode = self.safeMode
 
         for extension in self.registeredExtensions:
             extension.reset()
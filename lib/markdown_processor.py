@@ -43,9 +43,9 @@ import re
 
 from markdown import TextPreprocessor
 
-from pygments import highlight
 from pygments.formatters import HtmlFormatter
-from pygments.lexers import get_lexer_by_name, TextLexer
+
+from highlighting import highlight
 
 
 class CodeBlockPreprocessor(TextPreprocessor):
@@ -57,11 +57,7 @@ class CodeBlockPreprocessor(TextPreprocessor):
 
     def run(self, lines):
         def repl(m):
-            try:
-                lexer = get_lexer_by_name(m.group(1))
-            except ValueError:
-                lexer = TextLexer()
-            code = highlight(m.group(2), lexer, self.formatter)
+            code = highlight(m.group(2), m.group(1), self.formatter)
             i = code.rfind("%s</pre></div>" % LINEENDING)
             code = code[:i] + code[i+len(LINEENDING):]
             return "\n\n%s\n\n" % code.strip()
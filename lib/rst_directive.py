@@ -55,8 +55,7 @@ VARIANTS = {
 from docutils import nodes
 from docutils.parsers.rst import directives, Directive
 
-from pygments import highlight
-from pygments.lexers import get_lexer_by_name, TextLexer
+from highlighting import highlight
 
 class Pygments(Directive):
     """ Source code syntax hightlighting.
@@ -69,14 +68,11 @@ class Pygments(Directive):
 
     def run(self):
         self.assert_has_content()
-        try:
-            lexer = get_lexer_by_name(self.arguments[0])
-        except ValueError:
-            # no lexer found - use the text one instead of an exception
-            lexer = TextLexer()
         # take an arbitrary option if more than one is given
         formatter = self.options and VARIANTS[self.options.keys()[0]] or DEFAULT
-        parsed = highlight(u'\n'.join(self.content), lexer, formatter)
+        # unknown lexers fall back to the text one instead of an exception
+        parsed = highlight(u'\n'.join(self.content), self.arguments[0],
+                           formatter)
         return [nodes.raw('', parsed, format='html')]
 
 directives.register_directive('sourcecode', Pygments)
@@ -2,29 +2,31 @@ import datetime
 import itertools
 import os
 
-import urllib
 import webapp2
 
 from google.appengine.api import memcache
-from google.appengine.api import urlfetch
 from google.appengine.ext import db
 
 import basehandler
+import cacheutil
 import config
 import models
 
 
 class BlogPostHandler(basehandler.BaseHandler):
-  @basehandler.cached()
   def get(self, post_key):
+    if not self.is_known_path(post_key):
+      return self.fail_to_response(404)
+    self.get_post(post_key)
+
+  @basehandler.cached()
+  def get_post(self, post_key):
+    self.add_deps(cacheutil.post_dep(post_key))
     post = models.BlogPost.get_by_key_name(post_key)
     if not post or post.is_deleted:
       return self.fail(error=404, template='404.html')
 
-    prev, next = models.BlogPost.get_prev_next(post)
     self.templ['post'] = post
-    self.templ['prev'] = prev
-    self.templ['next'] = next
 
     return self.render('post.html')
 
@@ -33,23 +35,26 @@ class PostListingHandler(basehandler.BaseHandler):
   @basehandler.cached()
   def get(self, page_nr=1):
     page = int(page_nr) or 1
-
-    # We're limiting ourselves to 1000 blog posts here, but protecting
-    # us against a DoS, where someone enters large numbers and causes
-    # all entities to be retrieved over and over again.
-    if page < 1 or page > 100:
+    if page < 1:
       return self.fail(404)
 
-    q = models.BlogPost.all().order('-published')
-    q.filter('published !=', None)
-    q.filter('is_deleted =', False)
+    def make_query(keys_only):
+      q = models.BlogPost.all(keys_only=keys_only).order('-published')
+      q.filter('published >', models.MIN_PUBLISHED)
+      q.filter('is_deleted =', False)
+      return q
 
-    # This is not super-efficient, as if we're on, say, page 10, the first 90
-    # blog posts are retrieved and discarded. Since we're not going to have
-    # hundreds of pages though, probably not worth to over-optimize.
-    self.templ['posts'] = q.run(offset=(page-1)*10, limit=10)
+    self.add_deps(cacheutil.LISTING_DEP)
+    posts = models.fetch_page(make_query, 'listing', cacheutil.LISTING_DEP,
+                              page, generation=self.get_generation())
+    if not posts and page > 1:
+      return self.fail(404)
+
+    self.templ['posts'] = posts
+    self.templ['summaries'] = self.render_summaries(posts)
     self.templ['page'] = page
     self.templ['page_path'] = '/page'
+    self.templ['first_page_path'] = '/'
 
     return self.render('listing.html')
 
@@ -64,12 +69,16 @@ class ArchiveHandler(basehandler.BaseHandler):
     end = start + datetime.timedelta(days=32)
     end = end.replace(day=1) - datetime.timedelta(milliseconds=1)
 
+    self.add_deps(cacheutil.month_dep(year, month))
+
     q = models.BlogPost.all().order('-published')
     q.filter('published >', start)
     q.filter('published <', end)
     q.filter('is_deleted =', False)
 
-    self.templ['posts'] = q.run()
+    posts = list(q.run())
+    self.templ['posts'] = posts
+    self.templ['summaries'] = self.render_summaries(posts)
 
     return self.render('listing.html')
 
@@ -77,6 +86,7 @@ class ArchiveHandler(basehandler.BaseHandler):
 class ArchiveIndexHandler(basehandler.BaseHandler):
   @basehandler.cached()
   def get(self):
+    self.add_deps(cacheutil.ARCHIVE_INDEX_DEP)
     q = models.BlogDate.all().order('-__key__')
     dates = [entry.date for entry in q]
     date_struct = {}
@@ -96,17 +106,28 @@ class TagsHandler(basehandler.BaseHandler):
     if '/' in tag:
       (tag, page) = tag.split('/')
 
-    page = int(page) or 1
-    if page < 1 or page > 10:
+    page = int(page or 1) or 1
+    if page < 1:
       return self.fail(404)
 
-    q = models.BlogPost.all().order('-published')
-    q.filter('normalized_tags =', tag)
-    q.filter('is_deleted =', False)
+    def make_query(keys_only):
+      q = models.BlogPost.all(keys_only=keys_only).order('-published')
+      q.filter('normalized_tags =', tag)
+      q.filter('is_deleted =', False)
+      return q
+
+    dep = cacheutil.tag_dep(tag)
+    self.add_deps(dep)
+    posts = models.fetch_page(make_query, 'tag:' + tag, dep, page,
+                              generation=self.get_generation())
+    if not posts and page > 1:
+      return self.fail(404)
 
-    self.templ['posts'] = q.run(offset=(page-1)*10, limit=10)
+    self.templ['posts'] = posts
+    self.templ['summaries'] = self.render_summaries(posts)
     self.templ['page'] = page
     self.templ['page_path'] = '/tag/' + tag
+    self.templ['first_page_path'] = '/tag/' + tag
 
     return self.render('listing.html')
 
@@ -114,27 +135,26 @@ class TagsHandler(basehandler.BaseHandler):
 class AtomHandler(basehandler.BaseHandler):
   @basehandler.cached('application/atom+xml; charset=utf-8')
   def get(self):
+    self.add_deps(cacheutil.FEED_DEP)
     q = models.BlogPost.all().order('-updated')
     q.filter('is_deleted =', False)
     self.templ['posts'] = list(itertools.islice((x for x in q if x.published), 10))
     self.templ['updated'] = datetime.datetime.now().replace(second=0, microsecond=0)
 
-    if not self.templ['devel'] and config.hubbub_hub_url:
-      self.send_hubbub_ping(config.hubbub_hub_url)
-
     return self.render('atom.xml')
 
-  def send_hubbub_ping(self, hub_url):
-    data = urllib.urlencode({
-        'hub.url': 'http://%s/feeds/atom.xml' % (config.host,),
-        'hub.mode': 'publish',
-    })
-    response = urlfetch.fetch(url=hub_url, payload=data, method=urlfetch.POST)
-
 
 class PageContentHandler(basehandler.BaseHandler):
-  @basehandler.cached()
   def get(self, page):
+    # Unknown paths, e.g. of bots probing for other software, are answered
+    # without a datastore lookup or a cache entry.
+    if not self.is_known_path(page):
+      return self.fail_to_response(404)
+    self.get_page(page)
+
+  @basehandler.cached()
+  def get_page(self, page):
+    self.add_deps(cacheutil.page_dep(page))
     page = models.Page.get_by_key_name(page)
     if not page:
       return self.fail(404)
@@ -152,8 +172,9 @@ class SearchHandler(basehandler.BaseHandler):
 
 
 class SitemapHandler(basehandler.BaseHandler):
-  @basehandler.cached()
+  @basehandler.cached(max_stale=3600)
   def get(self):
+    self.add_deps(cacheutil.SITEMAP_DEP)
     q = models.BlogPost.all()
     q.filter('is_deleted =', False)
 
@@ -174,7 +195,14 @@ class SitemapHandler(basehandler.BaseHandler):
     return self.render('sitemap.xml')
 
 
+class WarmupHandler(webapp2.RequestHandler):
+  def get(self):
+    import highlighting
+    highlighting.precompile(config.highlight_precompile_lexers)
+
+
 app = webapp2.WSGIApplication([
+    ('/_ah/warmup', WarmupHandler),
     ('/', PostListingHandler),
     ('/feeds/atom.xml', AtomHandler),
     ('/sitemap.xml', SitemapHandler),
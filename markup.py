@@ -10,70 +10,267 @@ The following markup languages are supported:
 
 For ReStructuredText and Markdown syntax highlighting of source code is
 available.
+
+The markup engines are imported when a post in their language is rendered
+first, so that instances serving cached pages don't pay for importing them.
 """
 
-# TODO: Add summary rendering.
 # TODO: Docstrings.
 
+import copy
 import logging
+import pickle
 import re
+import threading
 from cStringIO import StringIO
 
-from django.utils import html
-from django.utils import text
-
 import config
 import utils
 
-# Import markup module from lib/
-import markdown
-import markdown_processor
-import rst_directive
-import textile
-from docutils.core import publish_parts
 
+# A comment containing 'cut' on a single line, e.g. <!-- cut -->. Doesn't
+# extend over other comments on the same line.
+CUT_SEPARATOR_RE = re.compile(r'<!--[^>\n]*?cut[^>\n]*?-->')
+
+# Bump this whenever a change to this module changes the rendered output.
+RENDER_REVISION = 2
+
+# Settings of the reStructuredText publisher.
+RST_SETTINGS = {
+    '_disable_config': True,
+    'embed_stylesheet': False,
+    'report_level': 2,
+}
+
+# Markup languages rendered by the worker processes, if there are any.
+POOLED_MARKUP = ('rst', 'markdown')
+
+# Renderer state of the current thread, see get_rst_publisher() and
+# get_markdown().
+_local = threading.local()
+
+# Pool of rendering processes, False if it can't be started, see get_pool().
+_pool = None
+_pool_lock = threading.Lock()
 
-CUT_SEPARATOR_REGEX = r'<!--.*cut.*-->'
+# Whether this is a rendering process.
+_in_worker = False
+
+
+def get_rst_publisher(warning_stream):
+  """Returns a docutils publisher for a new document.
+
+  Building the settings, reader, parser and writer costs more than parsing a
+  short post, so each thread builds them once and reuses them.
+
+  Args:
+    warning_stream: file-like object the warnings of the document go to.
+  """
+  from docutils import core
+  from docutils import io
+  # Registers the sourcecode directive.
+  import rst_directive
+
+  components = getattr(_local, 'rst_components', None)
+  if components is None:
+    pub = core.Publisher(source_class=io.StringInput,
+                         destination_class=io.StringOutput)
+    pub.set_components('standalone', 'restructuredtext', 'html4css1')
+    pub.process_programmatic_settings(None, RST_SETTINGS, None)
+    components = (pub.settings, pub.reader, pub.parser, pub.writer)
+    _local.rst_components = components
+
+  settings, reader, parser, writer = components
+  settings = copy.copy(settings)
+  settings.warning_stream = warning_stream
+  return core.Publisher(reader, parser, writer, settings=settings,
+                        source_class=io.StringInput,
+                        destination_class=io.StringOutput)
 
 
 def render_rst(content):
   warning_stream = StringIO()
-  parts = publish_parts(content, writer_name='html4css1',
-                        settings_overrides={
-                          '_disable_config': True,
-                          'embed_stylesheet': False,
-                          'warning_stream': warning_stream,
-                          'report_level': 2,
-                        })
+  pub = get_rst_publisher(warning_stream)
+  pub.set_source(content)
+  pub.set_destination()
+  pub.publish()
   rst_warnings = warning_stream.getvalue()
   if rst_warnings:
       logging.warn(rst_warnings)
-  return parts['html_body']
+  return pub.writer.parts['html_body']
+
+
+def get_markdown():
+  """Returns the Markdown converter of this thread, ready for a new document.
+
+  Setting up a converter is as expensive as converting a short post, so each
+  thread keeps one and resets it between documents.
+  """
+  import markdown
+  import markdown_processor
+
+  md = getattr(_local, 'markdown', None)
+  if md is None:
+    md = markdown.Markdown()
+    md.textPreprocessors.insert(0, markdown_processor.CodeBlockPreprocessor())
+    _local.markdown = md
+  else:
+    md.reset()
+  return md
 
 
 def render_markdown(content):
-  md = markdown.Markdown()
-  md.textPreprocessors.insert(0, markdown_processor.CodeBlockPreprocessor())
-  return md.convert(content)
+  return get_markdown().convert(content)
 
 
 def render_textile(content):
+  import textile
   return textile.textile(content.encode('utf-8'))
 
 
+def render_text(content):
+  from django.utils import html
+  return html.linebreaks(html.escape(content))
+
+
 # Mapping: string ID -> (human readable name, renderer)
 MARKUP_MAP = {
     'html':     ('HTML', lambda c: c),
-    'txt':      ('Plain Text', lambda c: html.linebreaks(html.escape(c))),
+    'txt':      ('Plain Text', render_text),
     'markdown': ('Markdown', render_markdown),
     'textile':  ('Textile', render_textile),
     'rst':      ('ReStructuredText', render_rst),
 }
 
 
+# Mapping: string ID -> (module, version attribute) of the engines its
+# renderer depends on
+ENGINE_MODULES = {
+    'markdown': [('markdown', 'version'), ('pygments', '__version__')],
+    'textile':  [('textile', '__version__')],
+    'rst':      [('docutils', '__version__'), ('pygments', '__version__')],
+}
+
+# Mapping: string ID -> version string of its engines, see
+# get_engine_version()
+_engine_versions = {}
+
+
+def get_engine_version(markup):
+  """Returns the versions of the engines a markup language depends on."""
+  version = _engine_versions.get(markup)
+  if version is None:
+    version = ','.join('%s-%s' % (name, getattr(__import__(name), attr))
+                       for name, attr in ENGINE_MODULES.get(markup, []))
+    _engine_versions[markup] = version
+  return version
+
+
+def get_render_version(post):
+  """Returns a stamp identifying the output of rendering this post now.
+
+  Stored renderings of the post are outdated if they carry another stamp, i.e.
+  the markup language, an engine or the summary length changed since.
+  """
+  return '%d:%s:%s:%d' % (RENDER_REVISION, post.body_markup,
+                          get_engine_version(post.body_markup),
+                          config.summary_length)
+
+
+def _init_worker():
+  global _in_worker
+  _in_worker = True
+
+
+def get_pool():
+  """Returns the pool of rendering processes, or None to render in process.
+
+  The pool is started on first use if config.render_processes is set.
+  """
+  global _pool
+  if not config.render_processes or _in_worker:
+    return None
+  with _pool_lock:
+    if _pool is None:
+      try:
+        import multiprocessing
+        _pool = multiprocessing.Pool(config.render_processes, _init_worker)
+      except Exception:
+        # E.g. in the daemonic worker processes of static_export.
+        logging.exception('Could not start rendering processes, rendering '
+                          'in process.')
+        _pool = False
+  return _pool or None
+
+
+def _render(markup, content):
+  return MARKUP_MAP[markup][1](content)
+
+
+def _render_post(markup, body):
+  return render_body_and_summary(PostSource(markup, body),
+                                 MARKUP_MAP[markup][1])
+
+
+def _get_result(result, render, *args):
+  """Returns the result of a job of the pool, or renders it in process.
+
+  Only failures of the pool fall back to rendering in process: a job that
+  timed out, e.g. as its process died, or whose arguments or result could not
+  be pickled. Errors of the rendering itself are raised, as in process.
+
+  Args:
+    result: the multiprocessing.AsyncResult of the job, or None.
+    render: function rendering the job in process.
+    args: the arguments of the job.
+  """
+  if result:
+    import multiprocessing
+    import multiprocessing.pool
+    try:
+      return result.get(config.render_timeout)
+    except (multiprocessing.TimeoutError,
+            multiprocessing.pool.MaybeEncodingError, pickle.PicklingError):
+      logging.exception('Rendering process failed, rendering in process.')
+  return render(*args)
+
+
+class PostSource(object):
+  """Markup and body of a post, as sent to the rendering processes."""
+
+  def __init__(self, body_markup, body):
+    self.body_markup = body_markup
+    self.body = body
+
+
 def get_renderer(post):
   """Returns a render function for this posts body markup."""
-  return MARKUP_MAP.get(post.body_markup)[1]
+  renderer = MARKUP_MAP.get(post.body_markup)[1]
+  pool = post.body_markup in POOLED_MARKUP and get_pool()
+  if pool:
+    def render_in_pool(content):
+      result = pool.apply_async(_render, (post.body_markup, content))
+      return _get_result(result, renderer, content)
+    return render_in_pool
+  return renderer
+
+
+def render_batch(posts):
+  """Renders the bodies and summaries of several posts.
+
+  With rendering processes, the posts in one of the POOLED_MARKUP languages
+  are submitted all at once and render in parallel, the others render in
+  process meanwhile.
+
+  Returns:
+    A list of (body, summary) tuples, in the order of the posts.
+  """
+  pool = get_pool()
+  jobs = [(post.body_markup, post.body) for post in posts]
+  results = [pool and job[0] in POOLED_MARKUP and
+             pool.apply_async(_render_post, job) for job in jobs]
+  return [_get_result(result, _render_post, *job)
+          for result, job in zip(results, jobs)]
 
 
 def clean_content(content):
@@ -81,7 +278,13 @@ def clean_content(content):
 
   Actually this removes the cut separator.
   """
-  return re.sub(CUT_SEPARATOR_REGEX, '', content)
+  return CUT_SEPARATOR_RE.sub('', content)
+
+
+def truncate_summary(body_html):
+  """Returns the first config.summary_length words of a rendered body."""
+  from django.utils import text
+  return text.truncate_html_words(body_html, config.summary_length)
 
 
 def render_body(post):
@@ -90,12 +293,18 @@ def render_body(post):
   return renderer(clean_content(post.body))
 
 
-def render_summary(post):
-  """Return the post's summary rendered to HTML."""
-  renderer = get_renderer(post)
-  match = re.search(CUT_SEPARATOR_REGEX, post.body)
+def render_body_and_summary(post, renderer=None):
+  """Returns the post's body and summary rendered to HTML.
+
+  The body is searched for the cut separator once. The summary is the part
+  before it or, without one, truncated from the rendered body instead of
+  rendering the whole body again.
+  """
+  renderer = renderer or get_renderer(post)
+  match = CUT_SEPARATOR_RE.search(post.body)
   if match:
-    return renderer(post.body[:match.start(0)])
-  else:
-    return text.truncate_html_words(renderer(clean_content(post.body)),
-                                    config.summary_length)
+    head = post.body[:match.start()]
+    body_html = renderer(head + clean_content(post.body[match.end():]))
+    return body_html, renderer(head)
+  body_html = renderer(post.body)
+  return body_html, truncate_summary(body_html)
@@ -1,14 +1,20 @@
 import aetycoon
 import datetime
 import hashlib
+import logging
 import re
+import time
 
 from google.appengine.api import memcache
 from google.appengine.ext import db
+from google.appengine.ext import deferred
 
+import cacheutil
 import config
+import hubbub
 import markup
 import utils
+import warmer
 
 
 if config.default_markup in markup.MARKUP_MAP:
@@ -16,6 +22,230 @@ if config.default_markup in markup.MARKUP_MAP:
 else:
   DEFAULT_MARKUP = 'html'
 
+# Cache dependencies that change whenever any published post changes.
+POST_GLOBAL_DEPS = (cacheutil.LISTING_DEP, cacheutil.FEED_DEP,
+                    cacheutil.SITEMAP_DEP, cacheutil.ARCHIVE_INDEX_DEP)
+
+# Cache dependencies that change whenever any page changes.
+PAGE_DEPS = (cacheutil.SITEMAP_DEP, cacheutil.PAGES_DEP)
+
+# Precedes every publication date. A 'published >' filter on it selects the
+# published posts with a single range, while 'published !=' None runs as a
+# MultiQuery, which has no cursors.
+MIN_PUBLISHED = datetime.datetime.min
+
+
+def invalidate(deps):
+  """Invalidates everything built from the given cache dependencies.
+
+  Besides the cached pages, these are the files of the static export, if
+  config.static_export_dir is set. They are regenerated by a deferred task.
+  Changes to the feed are announced to the PubSubHubbub hub, and changes to
+  the listings are followed by warming the cache.
+  """
+  cacheutil.invalidate(deps)
+  if cacheutil.FEED_DEP in deps:
+    hubbub.schedule_ping()
+  if cacheutil.LISTING_DEP in deps:
+    warmer.schedule('publish')
+  if config.static_export_dir:
+    import static_export
+    deferred.defer(static_export.regenerate, sorted(deps),
+                   _countdown=static_export.REGENERATE_DELAY)
+
+
+# Seconds the set of known paths is kept in memcache. Bounds how long a set
+# missing a change, e.g. from concurrent updates, can be served.
+KNOWN_PATHS_TTL = 3600
+
+# Memcache key, set and expiry time of the known paths of this instance, see
+# get_known_paths().
+_known_paths = (None, None, 0)
+
+
+def _get_known_paths_key(versions):
+  return cacheutil.namespaced(
+      'known-paths:%s' % versions[cacheutil.PATHS_DEP],
+      versions[cacheutil.GENERATION_DEP])
+
+
+def _query_known_paths():
+  paths = set(page_key.name() for page_key in Page.all(keys_only=True))
+  q = BlogPost.all(keys_only=True)
+  q.filter('is_deleted =', False)
+  paths.update(post_key.name() for post_key in q)
+  return paths
+
+
+def _read_known_paths(key):
+  """Returns the set of known paths stored under key, or None if missing."""
+  header = memcache.get(key)
+  if header is None:
+    return None
+  stamp, count = header
+  keys = ['%s:%s:%d' % (key, stamp, i) for i in range(count)]
+  chunks = memcache.get_multi(keys)
+  if len(chunks) < count:
+    return None
+  data = ''.join(chunks[chunk_key] for chunk_key in keys)
+  return frozenset(data and data.decode('utf-8').split('\n'))
+
+
+def _write_known_paths(key, paths, replace):
+  """Stores a set of known paths under key.
+
+  The set is split into chunks fitting into memcache values, stored under
+  keys unique to its content, so that concurrent writes never mix chunks.
+  The header, naming the chunks, is stored last.
+
+  Args:
+    key: memcache key of the set.
+    paths: the set of paths.
+    replace: whether to replace a set already stored under key.
+  """
+  data = '\n'.join(sorted(paths)).encode('utf-8')
+  stamp = hashlib.sha1(data).hexdigest()
+  chunks = cacheutil.split(data)
+  memcache.set_multi(dict(('%s:%s:%d' % (key, stamp, i), chunk)
+                          for i, chunk in enumerate(chunks)),
+                     time=KNOWN_PATHS_TTL)
+  if replace:
+    memcache.set(key, (stamp, len(chunks)), time=KNOWN_PATHS_TTL)
+  else:
+    memcache.add(key, (stamp, len(chunks)), time=KNOWN_PATHS_TTL)
+
+
+def get_known_paths(versions=None):
+  """Returns the set of paths of all pages and posts.
+
+  Requests for other paths can be answered with a 404 without looking them up
+  in the datastore. The set is kept in memcache, split into chunks (see
+  _write_known_paths()), and in-process for up to KNOWN_PATHS_TTL seconds,
+  tied to the version of cacheutil.PATHS_DEP, which only changes when a path
+  is added or removed (see update_known_paths()). A missing set is built by a
+  single request at a time, holding a lease like cacheutil.render_once().
+
+  Args:
+    versions: the current versions of cacheutil.PATHS_DEP and
+      cacheutil.GENERATION_DEP, fetched if not given.
+
+  Returns:
+    The set of paths, or None while another request builds it.
+  """
+  global _known_paths
+  if versions is None:
+    versions = cacheutil.get_versions([cacheutil.PATHS_DEP,
+                                       cacheutil.GENERATION_DEP])
+  key = _get_known_paths_key(versions)
+  if _known_paths[0] == key and _known_paths[2] > time.time():
+    return _known_paths[1]
+
+  paths = _read_known_paths(key)
+  if paths is None:
+    lease_key = key + cacheutil.LEASE_SUFFIX
+    if not memcache.add(lease_key, 1, time=cacheutil.LEASE_TIMEOUT):
+      return None
+    try:
+      paths = frozenset(_query_known_paths())
+      # A set stored by update_known_paths() meanwhile wins, as it includes
+      # changes the query may not see yet. It may also replace this one
+      # later, so only sets read from memcache are kept in-process.
+      _write_known_paths(key, paths, replace=False)
+    finally:
+      memcache.delete(lease_key)
+    return paths
+  _known_paths = (key, paths, time.time() + KNOWN_PATHS_TTL)
+  return paths
+
+
+def update_known_paths(added=None, removed=None):
+  """Adds or removes a path in the set of known paths.
+
+  The set is updated in place and stored under a new version of
+  cacheutil.PATHS_DEP, rather than built again from a query, which may not
+  see the change yet.
+
+  Args:
+    added: path of a post or page that was just added.
+    removed: path of a post or page that was just removed.
+  """
+  versions = cacheutil.get_versions([cacheutil.PATHS_DEP,
+                                     cacheutil.GENERATION_DEP])
+  paths = _read_known_paths(_get_known_paths_key(versions))
+  if paths is None:
+    paths = _query_known_paths()
+  elif added in paths and removed not in paths:
+    return
+  paths = set(paths)
+  paths.add(added)
+  paths.discard(removed)
+  paths.discard(None)
+  versions[cacheutil.PATHS_DEP] = cacheutil.bump(cacheutil.PATHS_DEP)
+  _write_known_paths(_get_known_paths_key(versions), paths, replace=True)
+
+
+def fetch_page(make_query, table, dep, page,
+               page_size=config.posts_per_page, generation=None):
+  """Fetches one page of results of a query, using datastore cursors.
+
+  The start cursors of the pages are kept in a memcache table of the query,
+  tied to the current version of the given cache dependency. Once the cursor
+  of a page is known, fetching it costs the same as fetching the first page.
+  A missing cursor is found by a keys-only query from the closest known page
+  before it, which stores the cursors of all pages on the way. Once the
+  results run out, the last page is stored too, so that pages beyond it cost
+  no query.
+
+  Args:
+    make_query: function returning a new instance of the query, taking a
+      keys_only argument.
+    table: name of the cursor table, unique to the query, e.g. 'listing'.
+    dep: cache dependency that is invalidated whenever the results change.
+    page: number of the page to fetch, starting at 1.
+    page_size: number of results per page.
+    generation: the cache generation, if already known.
+
+  Returns:
+    The list of results on the page.
+  """
+  version = cacheutil.get_versions([dep])[dep]
+  table_key = cacheutil.namespaced(
+      'cursors:%s:%s:%d' % (table, version, page_size), generation)
+  cursors, last_page = memcache.get(table_key) or ({}, None)
+  if last_page and page > last_page:
+    return []
+
+  changed = False
+  if page > 1 and page not in cursors:
+    current = max([p for p in cursors if p < page] or [1])
+    q = make_query(keys_only=True)
+    while current < page:
+      if current > 1:
+        q.with_cursor(cursors[current])
+      if len(q.fetch(page_size)) < page_size:
+        last_page = current
+        break
+      current += 1
+      cursors[current] = q.cursor()
+    changed = True
+    if current < page:
+      memcache.set(table_key, (cursors, last_page))
+      return []
+
+  q = make_query(keys_only=False)
+  if page > 1:
+    q.with_cursor(cursors[page])
+  results = q.fetch(page_size)
+  if len(results) < page_size:
+    changed = changed or last_page != page
+    last_page = page
+  elif page + 1 not in cursors:
+    cursors[page + 1] = q.cursor()
+    changed = True
+  if changed:
+    memcache.set(table_key, (cursors, last_page))
+  return results
+
 
 class BlogDate(db.Model):
   """Contains a list of year-months for published blog posts."""
@@ -57,6 +287,14 @@ class BlogPost(db.Model):
   deps = aetycoon.PickleProperty()
   draft = db.TextProperty()
   is_deleted = db.BooleanProperty(default=False)
+  # Body and summary rendered to HTML, and the markup.get_render_version()
+  # stamp of the rendering.
+  rendered_body = db.TextProperty()
+  rendered_summary = db.TextProperty()
+  render_version = db.StringProperty(indexed=False)
+  # Paths of the chronologically previous and next published posts.
+  prev_path = db.StringProperty(indexed=False)
+  next_path = db.StringProperty(indexed=False)
 
   @aetycoon.TransformProperty(tags)
   def normalized_tags(tags):
@@ -69,12 +307,25 @@ class BlogPost(db.Model):
   @property
   def rendered(self):
     """Returns the rendered body."""
-    return markup.render_body(self)
+    self.render()
+    return self.rendered_body
 
   @property
   def summary(self):
     """Returns a summary of the blog post."""
-    return markup.render_summary(self)
+    self.render()
+    return self.rendered_summary
+
+  def render(self, force=False):
+    """Renders body and summary, unless the stored renderings are current.
+
+    This does not store the renderings in the datastore, update() does.
+    """
+    version = markup.get_render_version(self)
+    if force or self.render_version != version:
+      (self.rendered_body,
+       self.rendered_summary) = markup.render_batch([self])[0]
+      self.render_version = version
 
   @property
   def hash(self):
@@ -94,14 +345,86 @@ class BlogPost(db.Model):
         **dict([(prop, getattr(self, prop)) for prop in post_properties]))
     return new_post
 
+  def get_deps(self):
+    """Returns the cache dependencies of this post in its current state.
+
+    These are the post itself, its chronological neighbours (whose pages link
+    to it), its tag pages and its archive month. Drafts have none.
+    """
+    if not self.path or not self.published:
+      return []
+    deps = [cacheutil.post_dep(self.path),
+            cacheutil.month_dep(self.published.year, self.published.month)]
+    deps.extend(cacheutil.tag_dep(tag) for tag in self.normalized_tags)
+    for path in (self.prev_path, self.next_path):
+      if path:
+        deps.append(cacheutil.post_dep(path))
+    return deps
+
+  def update_deps(self):
+    """Refreshes the stored dependencies of this post.
+
+    Returns:
+      All dependencies affected by the change, i.e. the ones of the post's
+      previous state (e.g. tags that have been removed since), the current
+      ones, and the ones shared by all posts.
+    """
+    old_deps = set(self.deps or [])
+    self.deps = self.get_deps()
+    return old_deps.union(self.deps, POST_GLOBAL_DEPS)
+
+  def update_links(self):
+    """Keeps the post at its place in the chain of published posts.
+
+    Needs to be called whenever a post is published, deleted or its published
+    date changes. The previous and next posts are updated in the datastore,
+    the post itself is not.
+    """
+    if self.is_deleted or not self.path:
+      self.unlink()
+      return
+
+    prev, next = BlogPost.get_prev_next(self)
+    prev_path = prev and prev.path
+    next_path = next and next.path
+    if (prev_path, next_path) == (self.prev_path, self.next_path):
+      return
+
+    self.unlink()
+    # Get the neighbours again, as unlink() might just have changed them.
+    changed = []
+    prev, next = BlogPost.get_by_paths(prev_path, next_path)
+    if prev:
+      prev.next_path = self.path
+      self.prev_path = prev.path
+      changed.append(prev)
+    if next:
+      next.prev_path = self.path
+      self.next_path = next.path
+      changed.append(next)
+    db.put(changed)
+
+  def unlink(self):
+    """Removes the post from the chain, linking its neighbours instead."""
+    changed = []
+    prev, next = BlogPost.get_by_paths(self.prev_path, self.next_path)
+    if prev and prev.next_path == self.path:
+      prev.next_path = self.next_path
+      changed.append(prev)
+    if next and next.prev_path == self.path:
+      next.prev_path = self.prev_path
+      changed.append(next)
+    db.put(changed)
+    self.prev_path = self.next_path = None
+
   def update(self, body, is_draft=False):
     if is_draft:
       self.draft = body
     else:
-      memcache.flush_all()
       self.updated = datetime.datetime.now()
       self.draft = None
       self.body = body
+      self.render(force=True)
 
     if not self.path and not is_draft:
       # Post is being published for the first time
@@ -116,9 +439,13 @@ class BlogPost(db.Model):
       self.path = path
       if self.is_saved() or not is_draft:
         new_post = self.set_key_name(path)
+        new_post.update_links()
+        deps = new_post.update_deps()
         new_post.put()
         self.is_saved() and self.delete()
         BlogDate.create_for_post(new_post)
+        invalidate(deps)
+        update_known_paths(added=new_post.path)
         return new_post
 
     if not self.is_saved():
@@ -126,7 +453,14 @@ class BlogPost(db.Model):
       new_post.put()
       return new_post
 
+    if is_draft:
+      self.put()
+      return self
+
+    self.update_links()
+    deps = self.update_deps()
     self.put()
+    invalidate(deps)
     return self
 
   def remove(self):
@@ -135,16 +469,34 @@ class BlogPost(db.Model):
 
     # TODO: Delete BlogDate if this is the only entry for the date.
     self.is_deleted = True
+    self.update_links()
+    deps = self.update_deps()
     self.put()
-    memcache.flush_all()
+    invalidate(deps)
+    update_known_paths(removed=self.path)
+
+  @classmethod
+  def get_by_paths(cls, *paths):
+    """Gets posts by path with one batch get, None paths yield None."""
+    key_names = [path for path in paths if path]
+    posts = key_names and cls.get_by_key_name(key_names) or []
+    posts = dict(zip(key_names, posts))
+    return [posts.get(path) for path in paths]
 
   @classmethod
   def get_prev_next(cls, post):
-    """Retrieves the chronologically previous and next post for this post"""
+    """Queries the chronologically previous and next post for this post.
+
+    This is only needed to maintain the chain of posts, the neighbours of a
+    published post are stored in prev_path and next_path.
+    """
     q = cls.all().order('-published')
     q.filter('is_deleted =', False)
     q.filter('published <', post.published)
     prev = q.get()
+    if prev and not prev.path:
+      # Drafts have no published date, which sorts before all dates.
+      prev = None
 
     q = cls.all().order('published')
     q.filter('is_deleted =', False)
@@ -154,6 +506,51 @@ class BlogPost(db.Model):
     return prev,next
 
 
+def rebuild_post_links():
+  """Rebuilds the chain of previous and next links of all published posts.
+
+  Walks all posts in the order of publication in a single pass and only
+  stores the posts whose links changed. Meant to be run as deferred task.
+  """
+  q = BlogPost.all().order('published')
+  q.filter('is_deleted =', False)
+  q.filter('published !=', None)
+
+  changed = {}
+  deps = set()
+
+  def put_changed():
+    for post in changed.itervalues():
+      deps.update(post.update_deps())
+    db.put(changed.values())
+    changed.clear()
+
+  prev = None
+  count = 0
+  for post in q.run(batch_size=100):
+    if not post.path:
+      continue
+    prev_path = prev and prev.path
+    if post.prev_path != prev_path:
+      post.prev_path = prev_path
+      changed[post.path] = post
+    if prev and prev.next_path != post.path:
+      prev.next_path = post.path
+      changed[prev.path] = prev
+    prev = post
+    count += 1
+    if len(changed) >= 100:
+      # The current post may still change, which just stores it again.
+      put_changed()
+
+  if prev and prev.next_path:
+    prev.next_path = None
+    changed[prev.path] = prev
+  put_changed()
+  invalidate(deps)
+  logging.info('Rebuilt links of %d posts.', count)
+
+
 class Page(db.Model):
   # The URL path to the page.
   path = db.StringProperty(required=True)
@@ -176,10 +573,12 @@ class Page(db.Model):
   def publish(self):
     self._key_name = self.path
     self.put()
-    memcache.flush_all()
+    invalidate((cacheutil.page_dep(self.path),) + PAGE_DEPS)
+    update_known_paths(added=self.path)
 
   def remove(self):
     if not self.is_saved():   
       return
     self.delete()
-    memcache.flush_all()
+    invalidate((cacheutil.page_dep(self.path),) + PAGE_DEPS)
+    update_known_paths(removed=self.path)
@@ -0,0 +1,165 @@
+"""Renders all posts and pages again.
+
+Needed after a change to the rendered output, e.g. of a markup engine or the
+summary length. start() walks the posts and pages in batches of BATCH_SIZE,
+with a deferred task on the RERENDER_QUEUE per batch. Every task queues the
+task of the next batch before rendering its own, so batches render in
+parallel, up to the max_concurrent_requests of the queue.
+
+The datastore cursor passed to each task is the checkpoint of the run: a task
+that fails, e.g. at its deadline, is retried from the start of its batch,
+without affecting the other batches. Tasks are named after their batch, so a
+retried task doesn't queue its successor again.
+
+Posts whose rendering changed are stored and their cached pages invalidated.
+Pages have no stored rendering, their cached copies are invalidated and
+rendered again.
+"""
+
+import datetime
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+import basehandler
+import cacheutil
+import markup
+import models
+
+
+# Task queue of the rendering tasks.
+RERENDER_QUEUE = 'rerender'
+
+# Number of posts or pages rendered by one task.
+BATCH_SIZE = 20
+
+# Memcache key of the status of the last run, see get_status().
+STATUS_KEY = 'rerender-status'
+
+
+def start():
+  """Starts rendering all posts and pages."""
+  run_id = '%d' % (time.time() * 1000)
+  memcache.set(STATUS_KEY, {
+      'run_id': run_id,
+      'started': datetime.datetime.now(),
+      'start_time': time.time(),
+      'total': get_post_query().count(None) + models.Page.all().count(None),
+  })
+  _queue_batch(rerender_posts, run_id, 0, None)
+  _queue_batch(rerender_pages, run_id, 0, None)
+
+
+def get_post_query():
+  q = models.BlogPost.all()
+  q.filter('is_deleted =', False)
+  return q
+
+
+def _queue_batch(func, run_id, batch, cursor):
+  try:
+    deferred.defer(func, run_id, batch, cursor,
+                   _name='rerender-%s-%s-%d' % (run_id, func.__name__, batch),
+                   _queue=RERENDER_QUEUE)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    # A retried task already queued the next batch.
+    pass
+
+
+def _record(run_id, **counters):
+  memcache.offset_multi(counters, key_prefix='rerender:%s:' % run_id,
+                        initial_value=0)
+  memcache.set('rerender:%s:end_time' % run_id, time.time())
+
+
+def _store_rendering(key, body, body_html, summary_html, version):
+  """Stores the rendering of a post, unless its body changed meanwhile.
+
+  Returns:
+    The post if it was stored, else None.
+  """
+  post = db.get(key)
+  if not post or post.body != body:
+    return None
+  post.rendered_body = body_html
+  post.rendered_summary = summary_html
+  post.render_version = version
+  post.put()
+  return post
+
+
+def rerender_posts(run_id, batch, cursor):
+  """Renders a batch of posts. Runs as deferred task."""
+  q = get_post_query()
+  if cursor:
+    q.with_cursor(cursor)
+  posts = q.fetch(BATCH_SIZE)
+  if len(posts) == BATCH_SIZE:
+    _queue_batch(rerender_posts, run_id, batch + 1, q.cursor())
+
+  start_time = time.time()
+  changed = 0
+  deps = set()
+  # Drafts that were never published have no body to render. They still
+  # count as done, as they are part of the total.
+  posts_with_body = [post for post in posts if post.body is not None]
+  for post, (body_html, summary_html) in zip(
+      posts_with_body, markup.render_batch(posts_with_body)):
+    version = markup.get_render_version(post)
+    output_changed = (post.rendered_body != body_html or
+                      post.rendered_summary != summary_html)
+    if not output_changed and post.render_version == version:
+      continue
+    post = db.run_in_transaction(_store_rendering, post.key(), post.body,
+                                 body_html, summary_html, version)
+    if post and output_changed:
+      changed += 1
+      if post.published:
+        deps.update(post.get_deps())
+        deps.update(models.POST_GLOBAL_DEPS)
+  if deps:
+    models.invalidate(deps)
+  _record(run_id, posts=len(posts), changed=changed,
+          ms=int((time.time() - start_time) * 1000))
+
+
+def rerender_pages(run_id, batch, cursor):
+  """Renders the cached copies of a batch of pages. Runs as deferred task."""
+  q = models.Page.all()
+  if cursor:
+    q.with_cursor(cursor)
+  pages = q.fetch(BATCH_SIZE)
+  if len(pages) == BATCH_SIZE:
+    _queue_batch(rerender_pages, run_id, batch + 1, q.cursor())
+
+  start_time = time.time()
+  for page in pages:
+    # A refresh keeps a cached copy that is still current, so drop it first.
+    cacheutil.invalidate([cacheutil.page_dep(page.path)])
+    basehandler.refresh_page(page.path)
+  _record(run_id, pages=len(pages), ms=int((time.time() - start_time) * 1000))
+
+
+def get_status():
+  """Returns the progress of the last run, if any.
+
+  Returns:
+    None, or a dict with the 'started' datetime, the 'total' number of posts
+    and pages, the number of 'posts' and 'pages' rendered, the number of posts
+    whose rendering 'changed', the render time in 'ms' and the number of
+    posts and pages rendered 'per_second'.
+  """
+  status = memcache.get(STATUS_KEY)
+  if status:
+    counters = memcache.get_multi(
+        ['posts', 'changed', 'pages', 'ms', 'end_time'],
+        key_prefix='rerender:%s:' % status['run_id'])
+    for name in ('posts', 'changed', 'pages', 'ms'):
+      status[name] = counters.get(name, 0)
+    duration = counters.get('end_time', 0) - status['start_time']
+    status['per_second'] = (
+        duration > 0 and (status['posts'] + status['pages']) / duration or 0)
+  return status
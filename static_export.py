@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+"""Exports the whole blog as static files.
+
+Renders every public URL of the blog through the handlers in main_handlers
+and writes the output to a directory tree, together with the static files of
+the theme. The tree can be served by any web server, e.g. with nginx:
+
+  location / {
+    try_files $uri $uri/index.html =404;
+  }
+
+URLs without a file extension are written to <url>/index.html. The datastore
+is read from a local datastore file, as written by the development server.
+
+Once exported, the files can be kept up to date incrementally: with
+config.static_export_dir set, every change to a post or page queues a
+deferred regenerate() task, which renders only the URLs built from the
+changed cache dependencies.
+
+Usage:
+  static_export.py --sdk ~/google_appengine \\
+      --datastore_path ~/bloggart.datastore /var/www/blog
+"""
+
+import logging
+import math
+import multiprocessing
+import optparse
+import os
+import re
+import shutil
+import sys
+import time
+
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# URLs with content independent of the posts and pages.
+FIXED_URLS = ['/', '/feeds/atom.xml', '/sitemap.xml', '/archive/']
+
+# URLs of the listing pages, which fetch their posts with the cursor tables of
+# models.fetch_page().
+LISTING_URL_RE = re.compile(r'^/(page/\d+|tag/[\w-]+(/\d+)?)?$')
+
+# Seconds to wait before regenerating files after a change, so that queries
+# see the change.
+REGENERATE_DELAY = 5
+
+# Name of the file in the export directory that regenerate() reports to.
+CHANGES_LOG = '.changes.log'
+
+# Handlers of the rendering processes.
+_app = None
+
+
+def get_app_id():
+  """Returns the application ID as the development server uses it."""
+  app_yaml = open(os.path.join(APP_DIR, 'app.yaml')).read()
+  match = re.search(r'^application:\s*(\S+)', app_yaml, re.M)
+  return 'dev~' + match.group(1)
+
+
+def setup_sdk(sdk_path):
+  """Makes the App Engine SDK and the libraries of the app importable."""
+  sys.path.insert(0, sdk_path)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  sys.path.insert(0, APP_DIR)
+  sys.path.insert(0, os.path.join(APP_DIR, 'lib'))
+
+
+def setup_stubs(options):
+  """Sets up the API stubs, with the datastore read from a local file.
+
+  Changes to the datastore, e.g. by the cache, are never written back.
+  """
+  from google.appengine.ext import testbed
+
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.setup_env(overwrite=True,
+                app_id=options.app_id or get_app_id(),
+                CURRENT_VERSION_ID='static-export.1',
+                SERVER_SOFTWARE='Bloggart static export',
+                DJANGO_SETTINGS_MODULE='settings')
+  bed.init_datastore_v3_stub(datastore_file=options.datastore_path,
+                             use_sqlite=options.use_sqlite,
+                             save_changes=False)
+  bed.init_memcache_stub()
+  bed.init_user_stub()
+  bed.init_taskqueue_stub(root_path=APP_DIR)
+  return bed
+
+
+def init_worker(options):
+  """Initializes a rendering process."""
+  global _app
+  setup_sdk(options.sdk)
+  setup_stubs(options)
+
+  import main_handlers
+  _app = main_handlers.app
+
+
+def render_url(url):
+  """Renders a URL in a worker process.
+
+  Returns:
+    A (url, HTTP status, body, render time in seconds) tuple.
+  """
+  start = time.time()
+  response = _app.get_response(url)
+  return url, response.status_int, response.body, time.time() - start
+
+
+def get_urls():
+  """Returns all public URLs of the blog."""
+  import config
+  import models
+
+  urls = list(FIXED_URLS)
+  tag_counts = {}
+  post_count = 0
+
+  q = models.BlogPost.all()
+  q.filter('is_deleted =', False)
+  for post in q.run(batch_size=100):
+    if not post.path or not post.published:
+      continue
+    post_count += 1
+    urls.append(post.path)
+    for tag in post.normalized_tags:
+      tag_counts[tag] = tag_counts.get(tag, 0) + 1
+
+  page_count = int(math.ceil(post_count / float(config.posts_per_page)))
+  urls.extend('/page/%d' % page for page in range(2, page_count + 1))
+
+  for tag, count in sorted(tag_counts.iteritems()):
+    urls.append('/tag/%s' % tag)
+    page_count = int(math.ceil(count / float(config.posts_per_page)))
+    urls.extend('/tag/%s/%d' % (tag, page) for page in range(2, page_count + 1))
+
+  for date in models.BlogDate.all(keys_only=True):
+    urls.append('/archive/%s/' % date.name())
+
+  for page in models.Page.all().run(batch_size=100):
+    urls.append(page.path)
+
+  return urls
+
+
+def get_output_path(output_dir, url):
+  """Returns the file a URL is written to."""
+  path = url.lstrip('/')
+  if not path or path.endswith('/') or '.' not in path.rsplit('/', 1)[-1]:
+    path = os.path.join(path, 'index.html')
+  return os.path.join(output_dir, *path.split('/'))
+
+
+def write_output(output_dir, url, body):
+  """Writes the body of a URL to its file, unless it didn't change.
+
+  Returns:
+    True if the file was written, False if it already had this content.
+  """
+  filename = get_output_path(output_dir, url)
+  if os.path.exists(filename):
+    with open(filename, 'rb') as f:
+      if f.read() == body:
+        return False
+  elif not os.path.isdir(os.path.dirname(filename)):
+    os.makedirs(os.path.dirname(filename))
+  with open(filename, 'wb') as f:
+    f.write(body)
+  return True
+
+
+def remove_output(output_dir, url):
+  """Removes the file of a URL.
+
+  Returns:
+    True if the file existed.
+  """
+  filename = get_output_path(output_dir, url)
+  if not os.path.exists(filename):
+    return False
+  os.remove(filename)
+  return True
+
+
+def get_urls_for_deps(deps):
+  """Returns the URLs of the pages built from the given cache dependencies."""
+  import cacheutil
+  import config
+  import models
+
+  urls = []
+  for dep in deps:
+    kind, _, name = dep.partition(':')
+    if kind in ('post', 'page'):
+      urls.append(name)
+    elif kind == 'month':
+      urls.append('/archive/%s/' % name)
+    elif kind == 'tag':
+      q = models.BlogPost.all(keys_only=True)
+      q.filter('normalized_tags =', name)
+      q.filter('is_deleted =', False)
+      page_count = int(math.ceil(q.count() / float(config.posts_per_page)))
+      urls.append('/tag/%s' % name)
+      # Includes the page after the last one, which may need to be removed.
+      urls.extend('/tag/%s/%d' % (name, page)
+                  for page in range(2, page_count + 2))
+    elif dep == cacheutil.LISTING_DEP:
+      urls.append('/')
+      urls.extend('/page/%d' % page
+                  for page in range(2, config.static_regenerate_pages + 1))
+    elif dep == cacheutil.FEED_DEP:
+      urls.append('/feeds/atom.xml')
+    elif dep == cacheutil.SITEMAP_DEP:
+      urls.append('/sitemap.xml')
+    elif dep == cacheutil.ARCHIVE_INDEX_DEP:
+      urls.append('/archive/')
+  return sorted(set(urls))
+
+
+def regenerate(deps, output_dir=None):
+  """Regenerates the exported files built from the given cache dependencies.
+
+  Runs inside the app, usually as a deferred task queued by
+  models.invalidate(). Files of URLs that no longer exist are removed. The
+  changed files are logged and appended to CHANGES_LOG in the export
+  directory.
+
+  Returns:
+    A dict with the lists of 'changed', 'unchanged' and 'removed' URLs.
+  """
+  import basehandler
+  import config
+  import main_handlers
+
+  output_dir = os.path.join(APP_DIR, output_dir or config.static_export_dir)
+  report = {'changed': [], 'unchanged': [], 'removed': []}
+  for url in get_urls_for_deps(deps):
+    # Stale pages must not be served from the cache.
+    response = main_handlers.app.get_response(
+        url, environ={basehandler.REFRESH_ENVIRON_KEY: True})
+    if response.status_int == 200:
+      if write_output(output_dir, url, response.body):
+        report['changed'].append(url)
+      else:
+        report['unchanged'].append(url)
+    elif response.status_int == 404 and remove_output(output_dir, url):
+      report['removed'].append(url)
+
+  logging.info('Regenerated static export: %d changed, %d unchanged, '
+               '%d removed.', len(report['changed']),
+               len(report['unchanged']), len(report['removed']))
+  if not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+  with open(os.path.join(output_dir, CHANGES_LOG), 'a') as f:
+    timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
+    for status in ('changed', 'removed'):
+      for url in report[status]:
+        f.write('%s %s %s\n' % (timestamp, status, url))
+  return report
+
+
+def copy_static_files(output_dir, theme):
+  """Copies the static files of the theme and the default theme."""
+  themes = set(['default', theme or 'default'])
+  for name in themes:
+    src = os.path.join(APP_DIR, 'themes', name, 'static')
+    dst = os.path.join(output_dir, 'static', name)
+    if not os.path.isdir(src):
+      continue
+    if os.path.isdir(dst):
+      shutil.rmtree(dst)
+    shutil.copytree(src, dst)
+
+
+def export(options, output_dir, urls=None):
+  """Renders the given URLs, or all URLs, and writes them to output_dir.
+
+  Listing pages are rendered in this process, in order, so that every page
+  finds its cursor in the table stored by the page before it. The other URLs
+  render in the worker processes meanwhile.
+
+  Returns:
+    A list of (url, HTTP status, render time, changed) tuples, slowest first.
+  """
+  global _app
+  if urls is None:
+    urls = get_urls()
+  listing_urls = [url for url in urls if LISTING_URL_RE.match(url)]
+  other_urls = [url for url in urls if not LISTING_URL_RE.match(url)]
+
+  pool = multiprocessing.Pool(options.processes, init_worker, (options,))
+  results = []
+
+  def write(url, status, body, duration):
+    changed = False
+    if status == 200:
+      changed = write_output(output_dir, url, body)
+    else:
+      logging.warning('%s returned HTTP status %d, skipped.', url, status)
+    results.append((url, status, duration, changed))
+
+  try:
+    pooled = pool.imap_unordered(render_url, other_urls)
+    import main_handlers
+    _app = main_handlers.app
+    for url in listing_urls:
+      write(*render_url(url))
+    for result in pooled:
+      write(*result)
+  finally:
+    pool.close()
+    pool.join()
+
+  results.sort(key=lambda result: result[2], reverse=True)
+  return results
+
+
+def print_report(results, total_time):
+  """Prints the render time of every URL and a summary."""
+  for url, status, duration, changed in results:
+    print '%8.1f ms  %d  %s%s' % (duration * 1000, status, url,
+                                  changed and '  (changed)' or '')
+  render_time = sum(result[2] for result in results)
+  print '%d URLs rendered in %.1f s (%.1f s of rendering), %d files changed.' % (
+      len(results), total_time, render_time,
+      len([result for result in results if result[3]]))
+
+
+def parse_args(argv):
+  parser = optparse.OptionParser(usage='%prog [options] output_dir')
+  parser.add_option('--sdk', default=os.environ.get('APPENGINE_SDK', ''),
+                    help='path of the App Engine SDK')
+  parser.add_option('--datastore_path',
+                    help='datastore file written by the development server')
+  parser.add_option('--use_sqlite', action='store_true', default=False,
+                    help='the datastore file is a SQLite database')
+  parser.add_option('--app_id', help='application ID of the datastore file')
+  parser.add_option('--processes', type='int',
+                    default=multiprocessing.cpu_count(),
+                    help='number of rendering processes')
+  options, args = parser.parse_args(argv)
+  if len(args) != 1 or not options.datastore_path:
+    parser.error('an output directory and --datastore_path are required')
+  return options, args[0]
+
+
+def main(argv):
+  logging.basicConfig(level=logging.INFO)
+  options, output_dir = parse_args(argv)
+
+  setup_sdk(options.sdk)
+  setup_stubs(options)
+  import config
+
+  start = time.time()
+  results = export(options, output_dir)
+  copy_static_files(output_dir, config.theme)
+  print_report(results, time.time() - start)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
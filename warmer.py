@@ -0,0 +1,119 @@
+"""Warms the page cache after deploys and publishes.
+
+Pages of a new version are cached under new keys, and a publish invalidates
+the listings, so the first readers would pay for rendering them. Instead,
+schedule() queues a deferred task rendering the most requested pages, in
+order of priority: the front pages, the feed and the sitemap, the newest
+posts and the tag pages with the most recent posts. Pages are rendered by
+tasks on the WARM_QUEUE queue, whose max_concurrent_requests in queue.yaml
+limits how many run at the same time.
+"""
+
+import datetime
+import os
+import re
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+
+import config
+
+
+# Task queue of the warming tasks.
+WARM_QUEUE = 'warm'
+
+# Changes within this many seconds are followed by a single warming run.
+WARM_WINDOW = 30
+
+# Memcache key of the status of the last warming run, see get_status().
+STATUS_KEY = 'warm-status'
+
+
+def schedule(reason):
+  """Schedules warming the cache at the end of the current window.
+
+  Args:
+    reason: what made the cache cold, e.g. 'deploy' or 'publish'.
+  """
+  now = time.time()
+  window = int(now) // WARM_WINDOW
+  version = re.sub('[^a-zA-Z0-9-]', '-',
+                   os.environ.get('CURRENT_VERSION_ID', ''))
+  try:
+    deferred.defer(start, reason,
+                   _name='warm-%s-%d' % (version, window),
+                   _countdown=(window + 1) * WARM_WINDOW - now,
+                   _queue=WARM_QUEUE)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    # Another change in this window already scheduled warming.
+    pass
+
+
+def get_urls():
+  """Returns the URLs to warm, the most important first."""
+  import models
+
+  urls = ['/', '/feeds/atom.xml', '/sitemap.xml']
+  urls.extend('/page/%d' % page
+              for page in range(2, config.warm_listing_pages + 1))
+
+  # Only the newest posts are read, so that the cost doesn't grow with the
+  # blog. The tags are ranked by their recent posts.
+  q = models.BlogPost.all().order('-published')
+  q.filter('published >', models.MIN_PUBLISHED)
+  q.filter('is_deleted =', False)
+  tag_counts = {}
+  posts = q.fetch(max(config.warm_posts, config.warm_tag_posts))
+  for i, post in enumerate(posts):
+    if i < config.warm_posts:
+      urls.append(post.path)
+    for tag in post.normalized_tags:
+      tag_counts[tag] = tag_counts.get(tag, 0) + 1
+
+  tags = sorted(tag_counts, key=tag_counts.get, reverse=True)
+  urls.extend('/tag/%s' % tag for tag in tags[:config.warm_tags])
+  return urls
+
+
+def start(reason):
+  """Queues a task for every URL to warm. Runs as deferred task."""
+  urls = get_urls()
+  run_id = '%d' % (time.time() * 1000)
+  memcache.set(STATUS_KEY, {
+      'run_id': run_id,
+      'reason': reason,
+      'started': datetime.datetime.now(),
+      'total': len(urls),
+  })
+  # Tasks with the same ETA run roughly in the order they were added.
+  for url in urls:
+    deferred.defer(warm_url, run_id, url, _queue=WARM_QUEUE)
+
+
+def warm_url(run_id, url):
+  """Renders a page into the cache, unless it is current already."""
+  import basehandler
+
+  start_time = time.time()
+  basehandler.refresh_page(url)
+  duration = int((time.time() - start_time) * 1000)
+  memcache.offset_multi({'done': 1, 'ms': duration},
+                        key_prefix='warm:%s:' % run_id, initial_value=0)
+
+
+def get_status():
+  """Returns the progress of the last warming run, if any.
+
+  Returns:
+    None, or a dict with the 'reason', 'started' datetime, 'total' number of
+    URLs, the number of URLs 'done' and their render time in 'ms'.
+  """
+  status = memcache.get(STATUS_KEY)
+  if status:
+    counters = memcache.get_multi(['done', 'ms'],
+                                  key_prefix='warm:%s:' % status['run_id'])
+    status['done'] = counters.get('done', 0)
+    status['ms'] = counters.get('ms', 0)
+  return status